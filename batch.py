@@ -0,0 +1,174 @@
+import argparse
+import random
+import time
+import numpy as np
+from geometry import dir_to_ds
+
+DIRS = list(dir_to_ds)
+DX = np.array([dir_to_ds[d].x for d in DIRS])
+DY = np.array([dir_to_ds[d].y for d in DIRS])
+EMPTY = 0
+APPLE = 1
+BODY = 2
+HEAD = 3
+CODES = np.frombuffer(b".AcC", dtype=np.uint8)
+
+
+class batch_game:
+    def __init__(self, boards, width, height, apples_number, has_bound, seed=None):
+        self.boards = boards
+        self.width = width
+        self.height = height
+        self.size = width * height
+        self.apples_number = apples_number
+        self.has_bound = has_bound
+        self.rng = np.random.default_rng(seed)
+        self.grid = np.zeros((boards, width, height), dtype=np.int8)
+        self.cells = self.grid.reshape(boards, self.size)
+        self.body = np.zeros((boards, self.size), dtype=np.int64)
+        self.head = np.zeros(boards, dtype=np.int64)
+        self.tail = np.zeros(boards, dtype=np.int64)
+        self.dirs = np.zeros(boards, dtype=np.int64)
+        self.done = np.zeros(boards, dtype=bool)
+        self.apples = np.zeros(boards, dtype=np.int64)
+        self.reset()
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.boards, dtype=bool)
+        k = np.flatnonzero(mask)
+        y = self.height // 2
+        start = np.array(
+            [0 * self.height + y, 1 * self.height + y, 2 * self.height + y]
+        )
+        self.cells[k] = EMPTY
+        self.cells[k[:, None], start[None, :-1]] = BODY
+        self.cells[k, start[-1]] = HEAD
+        self.body[k, : len(start)] = start
+        self.tail[k] = 0
+        self.head[k] = len(start) - 1
+        self.dirs[k] = DIRS.index("R")
+        self.done[k] = False
+        self.apples[k] = 0
+        self.spawn_apples(k)
+
+    def spawn_apples(self, k):
+        k = k[self.apples[k] < self.apples_number]
+        need = self.apples_number - self.apples[k]
+        while len(k) > 0:
+            k, need = k[need > 0], need[need > 0]
+            if len(k) == 0:
+                break
+            scores = self.rng.random((len(k), self.size))
+            scores[self.cells[k] != EMPTY] = -1
+            cell = scores.argmax(axis=1)
+            free = scores[np.arange(len(k)), cell] >= 0
+            k, need, cell = k[free], need[free], cell[free]
+            self.cells[k, cell] = APPLE
+            self.apples[k] += 1
+            need -= 1
+
+    def set_apples(self, num, apples):
+        self.cells[num][self.cells[num] == APPLE] = EMPTY
+        self.cells[num, list(apples)] = APPLE
+        self.apples[num] = len(apples)
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        rewards = np.zeros(self.boards)
+        turn = (actions >= 0) & (actions // 2 != self.dirs // 2)
+        self.dirs = np.where(turn, actions, self.dirs)
+        k = np.flatnonzero(~self.done)
+        head = self.body[k, self.head[k]]
+        nx = head // self.height + DX[self.dirs[k]]
+        ny = head % self.height + DY[self.dirs[k]]
+        if self.has_bound:
+            inside = (0 <= nx) & (nx < self.width) & (0 <= ny) & (ny < self.height)
+        else:
+            nx %= self.width
+            ny %= self.height
+            inside = np.ones(len(k), dtype=bool)
+        new = np.where(inside, nx * self.height + ny, 0)
+        ate = inside & (self.cells[k, new] == APPLE)
+
+        moved = k[~ate]
+        self.cells[moved, self.body[moved, self.tail[moved]]] = EMPTY
+        self.tail[moved] = (self.tail[moved] + 1) % self.size
+
+        self.cells[k, head] = BODY
+        hit = inside & (self.cells[k, new] >= BODY)
+        self.cells[k[inside], new[inside]] = HEAD
+        self.head[k] = (self.head[k] + 1) % self.size
+        self.body[k, self.head[k]] = new
+
+        rewards[k[ate]] = 1
+        self.apples[k[ate]] -= 1
+        dead = k[hit | ~inside]
+        rewards[dead] = -1
+        self.done[dead] = True
+        self.spawn_apples(k)
+        self.done[k[self.apples[k] == 0]] = True
+        return rewards, self.done.copy()
+
+    def board_cells(self, num):
+        return bytearray(CODES[self.cells[num]].tobytes())
+
+
+def cross_check(seed, turns, width, height, apples_number, has_bound):
+    from server import game
+
+    rng = random.Random(seed)
+    g = game()
+    g.players_number = 1
+    g.width = width
+    g.height = height
+    g.apples_number = apples_number
+    g.has_bound = has_bound
+    g.turn_time = 0
+    g.build_start_pos(seed)
+    b = batch_game(1, width, height, apples_number, has_bound, seed)
+    b.set_apples(0, g.apples)
+    for turn in range(turns):
+        d = rng.choice(DIRS)
+        g.snakes[0].apply_direct(d)
+        g.make_turn()
+        rewards, done = b.step([DIRS.index(d)])
+        if b.apples[0] != len(g.apples):
+            return f"turn {turn}: apples {b.apples[0]} != {len(g.apples)}"
+        b.set_apples(0, g.apples)
+        if b.board_cells(0) != g.construc_grid():
+            return f"turn {turn}: boards differ"
+        if done[0] != g.end_game:
+            return f"turn {turn}: done {done[0]} != {g.end_game}"
+        if done[0]:
+            return None
+    return None
+
+
+def benchmark(boards, width, height, steps):
+    b = batch_game(boards, width, height, 3, False, seed=0)
+    rng = np.random.default_rng(0)
+    time_start = time.perf_counter()
+    for _ in range(steps):
+        b.step(rng.integers(0, len(DIRS), boards))
+        b.reset(b.done)
+    elapsed = time.perf_counter() - time_start
+    print(f"{boards} boards {width}x{height}: {boards * steps / elapsed:.0f} steps/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--boards", type=int, default=1024)
+    args = parser.parse_args()
+    failed = 0
+    for seed in range(args.seeds):
+        r = random.Random(seed)
+        params = (r.randint(4, 16), r.randint(4, 16), r.randint(1, 8), r.random() < 0.5)
+        error = cross_check(seed, args.turns, *params)
+        if error:
+            failed += 1
+            print(f"seed {seed} {params}: {error}")
+    print(f"cross-check: {args.seeds - failed}/{args.seeds} seeds match server.game")
+    benchmark(args.boards, 20, 20, 200)
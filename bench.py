@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import time
+import log
+import server
+from bot import ANSWERS
+from geometry import point
+from network import network_client
+from protocol import (
+    BYTE_CODE_SHIFT,
+    KEYFRAME_ENCODINGS,
+    KEYFRAME_RAW,
+    PROTO_BINARY,
+    decode_keyframe,
+    encode_delta,
+    encode_keyframe,
+    encode_text_keyframe,
+    frame,
+)
+from rules import occupancy, snake
+from scheduler import POLICIES, TIMERS
+
+SIZES = [10, 100, 1000]
+FILLS = [0.0, 0.1, 0.5, 0.9]
+
+
+def serpentine(width, height, length):
+    body = []
+    for x in range(width):
+        column = range(height) if x % 2 == 0 else range(height - 1, -1, -1)
+        body += [point(x, y) for y in column]
+    return body[:length]
+
+
+def make_game(size, length, apples_number=3, seed=0):
+    g = server.game()
+    g.players_number = 1
+    g.width = size
+    g.height = size
+    g.apples_number = apples_number
+    g.has_bound = False
+    g.turn_time = 0
+    g.build_start_pos(seed)
+    if length > 3:
+        b = g.get_board()
+        g.snakes = [snake(serpentine(size, size, length), 0, b)]
+        g.occupancy = occupancy(b)
+        g.changelog = []
+        g.snakes[0].add_occupancy(g.occupancy)
+        g.snakes[0].add_changelog(g.changelog)
+        g.apples = set()
+        g.gen_apples()
+    g.get_cells()
+    return g
+
+
+def measure(fn, budget, repeat=1000):
+    times = []
+    time_end = time.perf_counter() + budget
+    while len(times) < repeat and (len(times) < 3 or time.perf_counter() < time_end):
+        time_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - time_start)
+    times.sort()
+    return {
+        "runs": len(times),
+        "mean_us": sum(times) / len(times) * 1e6,
+        "median_us": times[len(times) // 2] * 1e6,
+        "min_us": times[0] * 1e6,
+    }
+
+
+def bench_game(size, fill, budget):
+    length = max(3, int(size * size * fill))
+    g = make_game(size, length)
+    result = {"size": size, "snake_length": length}
+
+    def make_turn():
+        g.make_turn()
+        g.changelog.clear()
+
+    def gen_apples():
+        for c in g.apples:
+            g.occupancy.remove(c)
+        g.apples.clear()
+        g.gen_apples()
+
+    text_delta = size + BYTE_CODE_SHIFT < 128
+
+    def get_delta():
+        g.make_turn()
+        time_start = time.perf_counter()
+        if text_delta:
+            g.get_delta()
+        else:
+            encode_delta(g.get_changes())
+        return time.perf_counter() - time_start
+
+    result["make_turn"] = measure(make_turn, budget)
+    result["gen_apples"] = measure(gen_apples, budget)
+    result["get_free_cell"] = measure(g.get_free_cell, budget)
+    result["construc_grid"] = measure(g.construc_grid, budget)
+    result["get_string"] = measure(g.get_string, budget)
+    g = make_game(size, length)
+    deltas = [get_delta() for _ in range(min(200, 10 + int(budget * 1000)))]
+    result["get_delta"] = {
+        "encoding": "text" if text_delta else "binary",
+        "runs": len(deltas),
+        "mean_us": sum(deltas) / len(deltas) * 1e6,
+    }
+    return result
+
+
+def bench_keyframes(size, fill, budget):
+    length = max(3, int(size * size * fill))
+    g = make_game(size, length)
+    cells = bytes(g.get_cells())
+    result = {"size": size, "snake_length": length}
+    text = encode_text_keyframe(size, size, cells)
+    encode = measure(lambda: encode_text_keyframe(size, size, cells), budget)
+    decode = measure(lambda: text.replace(",", "").replace(":", "").encode(), budget)
+    result["text"] = {
+        "bytes": len(text) + len("STATE_INIT|\n"),
+        "mean_us": encode["mean_us"],
+        "decode_mean_us": decode["mean_us"],
+    }
+    for encoding in KEYFRAME_ENCODINGS:
+        payload = encode_keyframe(size, size, cells, encoding)
+        encode = measure(lambda: encode_keyframe(size, size, cells, encoding), budget)
+        decode = measure(lambda: decode_keyframe(payload, encoding), budget)
+        result[encoding] = {
+            "bytes": len(payload),
+            "mean_us": encode["mean_us"],
+            "decode_mean_us": decode["mean_us"],
+        }
+    return result
+
+
+async def bench_client(port, duration, frames):
+    client = network_client(PROTO_BINARY, verbose=False, keyframe=KEYFRAME_RAW)
+    client.ip = "127.0.0.1"
+    client.port = port
+    await client.connect()
+    time_end = None
+    try:
+        while time_end is None or time.perf_counter() < time_end:
+            message = await client.read()
+            if isinstance(message, frame):
+                if time_end is None:
+                    time_end = time.perf_counter() + duration
+                frames.append(time.perf_counter())
+            elif message.startswith("PROTO|"):
+                await client.negotiate(message)
+            elif message in ANSWERS:
+                await client.write(ANSWERS[message])
+    finally:
+        client.writer.close()
+
+
+def worst_us(seconds):
+    worst = max(seconds, default=None)
+    return None if worst is None else worst * 1e6
+
+
+def number(value, digits):
+    return "n/a" if value is None else f"{value:.{digits}f}"
+
+
+async def bench_server(clients, size, turn_time, duration, policy, timer):
+    settings = {
+        "width": size,
+        "height": size,
+        "players_number": 1,
+        "turn_time": turn_time,
+        "apples_number": 3,
+        "has_bound": False,
+        "tick_policy": policy,
+        "tick_timer": timer,
+    }
+    server.load_config = lambda path=server.CONFIG_PATH: {
+        "game": settings,
+        "rooms": {},
+        "matches": [],
+    }
+    server.RECORD_REPLAYS = False
+    srv = server.server()
+    srv.init_rooms()
+    tcp = await asyncio.start_server(srv.handler, host="127.0.0.1", port=0)
+    port = tcp.sockets[0].getsockname()[1]
+    frames = [[] for _ in range(clients)]
+    tasks = [bench_client(port, duration, frames[i]) for i in range(clients)]
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=duration + 30)
+    tcp.close()
+    fps = [(len(f) - 1) / (f[-1] - f[0]) for f in frames if len(f) > 1]
+    tick = [r.metrics.phases["tick"] for r in srv.rooms]
+    jitter = [r.metrics.jitter for r in srv.rooms]
+    return {
+        "clients": clients,
+        "size": size,
+        "turn_time": turn_time,
+        "tick_policy": policy,
+        "tick_timer": timer,
+        "target_fps": 1 / turn_time,
+        "mean_fps": sum(fps) / len(fps) if fps else None,
+        "min_fps": min(fps, default=None),
+        "tick_p99_us": worst_us(h.quantile(0.99) for h in tick),
+        "tick_max_us": worst_us(h.max for h in tick),
+        "jitter_p99_us": worst_us(h.quantile(0.99) for h in jitter),
+        "skipped": sum(r.metrics.skipped for r in srv.rooms),
+    }
+
+
+def commit():
+    try:
+        args = ["git", "rev-parse", "--short", "HEAD"]
+        return subprocess.check_output(args, text=True).strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--fills", type=float, nargs="+", default=FILLS)
+    parser.add_argument("--budget", type=float, default=0.5)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--turn-time", type=float, default=0.05)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--tick-policy", choices=POLICIES, default="catch_up")
+    parser.add_argument("--tick-timer", choices=TIMERS, default="sleep")
+    parser.add_argument("--output", default="bench.json")
+    args = parser.parse_args()
+    log.setup("ERROR")
+    results = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "game": [],
+        "keyframes": [],
+        "server": [],
+    }
+    for size in args.sizes:
+        for fill in args.fills:
+            r = bench_game(size, fill, args.budget)
+            results["game"].append(r)
+            ops = ", ".join(
+                f"{k} {v['mean_us']:.1f}" for k, v in r.items() if isinstance(v, dict)
+            )
+            print(f"{size}x{size} length {r['snake_length']}: {ops} us")
+    for size in args.sizes:
+        for fill in args.fills:
+            r = bench_keyframes(size, fill, args.budget)
+            results["keyframes"].append(r)
+            sizes = ", ".join(
+                f"{k} {v['bytes']} B {v['mean_us']:.0f}/{v['decode_mean_us']:.0f}"
+                for k, v in r.items()
+                if isinstance(v, dict)
+            )
+            print(f"{size}x{size} keyframe, encode/decode us: {sizes}")
+    for clients in args.clients:
+        r = asyncio.run(
+            bench_server(
+                clients,
+                20,
+                args.turn_time,
+                args.duration,
+                args.tick_policy,
+                args.tick_timer,
+            )
+        )
+        results["server"].append(r)
+        print(
+            f"{clients} clients: {number(r['mean_fps'], 1)} fps "
+            f"(min {number(r['min_fps'], 1)}, target {r['target_fps']:.1f}), "
+            f"tick p99 {number(r['tick_p99_us'], 0)} us, "
+            f"jitter p99 {number(r['jitter_p99_us'], 0)} us"
+        )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
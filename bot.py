@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from geometry import dir_to_ds
+from network import TCP_PORT, network_client
+from protocol import KEYFRAME_ENCODINGS, KEYFRAME_RLE, PROTO_BINARY, PROTOCOLS, frame
+
+DIRS = list(dir_to_ds)
+ANSWERS = {
+    "TEST": "TEST_ANSWER",
+    "SPACE_AWAIT": "SPACE_PRESSED",
+    "PING": "PONG",
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class bot:
+    def __init__(self, num, ip, port, proto, keyframe, moves, turn_rate, seed):
+        self.num = num
+        self.network = network_client(proto, verbose=False, keyframe=keyframe)
+        self.network.ip = ip
+        self.network.port = port
+        self.moves = moves
+        self.turn_rate = turn_rate
+        self.rng = random.Random(seed)
+        self.arrivals = []
+        self.step = 0
+        self.error = None
+
+    def next_dir(self):
+        if self.moves == "random":
+            if self.rng.random() < self.turn_rate:
+                return self.rng.choice(DIRS)
+            return None
+        d = self.moves[self.step % len(self.moves)]
+        self.step += 1
+        return d if d in dir_to_ds else None
+
+    async def on_state(self):
+        self.arrivals.append(time.perf_counter())
+        d = self.next_dir()
+        if d is not None:
+            await self.network.write(d)
+
+    async def run(self):
+        try:
+            await self.network.connect()
+            while True:
+                message = await self.network.read()
+                if isinstance(message, frame):
+                    await self.on_state()
+                elif message.startswith("STATE|"):
+                    await self.on_state()
+                elif message.startswith("PROTO|"):
+                    await self.network.negotiate(message)
+                elif message in ANSWERS:
+                    await self.network.write(ANSWERS[message])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+
+    def intervals(self):
+        a = self.arrivals
+        return [a[i + 1] - a[i] for i in range(len(a) - 1)]
+
+
+def report(bots, turn_time, elapsed):
+    intervals = [b.intervals() for b in bots]
+    if turn_time is None:
+        turn_time = percentile(sum(intervals, []), 0.5)
+    connections = []
+    for b, values in zip(bots, intervals):
+        late = [(v - turn_time) * 1000 for v in values]
+        connections.append(
+            {
+                "num": b.num,
+                "frames": len(b.arrivals),
+                "error": repr(b.error) if b.error else None,
+                "late_ms": {
+                    "p50": percentile(late, 0.5),
+                    "p90": percentile(late, 0.9),
+                    "p99": percentile(late, 0.99),
+                    "max": max(late) if late else None,
+                },
+            }
+        )
+    measured = [c for c in connections if c["late_ms"]["p50"] is not None]
+    frames = sum(c["frames"] for c in connections)
+    summary = {
+        "connections": len(bots),
+        "receiving": len(measured),
+        "errors": sum(c["error"] is not None for c in connections),
+        "turn_time": turn_time,
+        "frames_per_second": frames / elapsed,
+    }
+    for q in ["p50", "p90", "p99", "max"]:
+        values = [c["late_ms"][q] for c in measured]
+        summary[f"late_{q}_ms"] = {
+            "median": percentile(values, 0.5),
+            "worst": max(values) if values else None,
+        }
+    return summary, connections
+
+
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def main(args):
+    ip = args.host
+    if ip is None:
+        ip = await network_client().choose_server()
+    bots = [
+        bot(
+            i,
+            ip,
+            args.port,
+            args.proto,
+            args.keyframe,
+            args.moves,
+            args.turn_rate,
+            args.seed + i,
+        )
+        for i in range(args.connections)
+    ]
+    tasks = []
+    for b in bots:
+        tasks.append(asyncio.create_task(b.run()))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / len(bots))
+    time_start = time.perf_counter()
+    print(f"{len(bots)} bots connected to {ip}:{args.port}, running {args.duration}s")
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - time_start
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for b in bots:
+        if b.network.writer:
+            b.network.writer.close()
+    summary, connections = report(bots, args.turn_time, elapsed)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "connections": connections}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=None, help="skip discovery")
+    parser.add_argument("--port", type=int, default=TCP_PORT)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--ramp", type=float, default=1.0)
+    parser.add_argument("--proto", choices=PROTOCOLS, default=PROTO_BINARY)
+    parser.add_argument("--keyframe", choices=KEYFRAME_ENCODINGS, default=KEYFRAME_RLE)
+    parser.add_argument("--moves", default="random", help='"random" or e.g. "RDLU"')
+    parser.add_argument("--turn-rate", type=float, default=0.2)
+    parser.add_argument("--turn-time", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    raise_file_limit()
+    asyncio.run(main(args))
@@ -1,12 +1,32 @@
+import argparse
 import asyncio
-import socket
+import threading
+import time
 import pygame
+from geometry import OUTSIDE, board, point
+from network import network_client
+from protocol import (
+    KEYFRAME_ENCODINGS,
+    KEYFRAME_RLE,
+    PROTO_BINARY,
+    STATE_INIT,
+    decode_delta,
+    decode_keyframe,
+    decode_text_delta,
+    frame,
+)
+from rules import find_dir, snake_num_to_chr, steering
 
-TCP_PORT = 8888
-UDP_PORT = 9999
-DISCOVERY_REQUEST = b"DISCOVER_SNAKE_GAME"
-DISCOVERY_RESPONSE_PREFIX = b"SNAKE_GAME_HERE"
-BYTE_CODE_SHIFT = 100
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SHOW_FPS = True
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 1.0
+REFRESH_RATE = 60
+CALL_EVENT = pygame.USEREVENT + 1
 
 key_to_dir = {
     pygame.K_RIGHT: "R",
@@ -25,136 +45,139 @@ code_to_color = {
 }
 
 
-class network_client:
-    def __init__(self):
-        self.state = "disconnected"
-        self.reader = None
-        self.writer = None
-
-    def get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-        finally:
-            s.close()
-
-    async def get_server_list(self, broadcast_addr, timeout=2.0):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.setblocking(False)
-
-        loop = asyncio.get_event_loop()
-        print(f"browsing servers on {broadcast_addr} ...")
-        await loop.run_in_executor(
-            None,
-            sock.sendto,
-            DISCOVERY_REQUEST,
-            (broadcast_addr, UDP_PORT),
-        )
-        servers = []
-        start_time = loop.time()
-        while loop.time() - start_time < timeout:
-            try:
-                local_timout = timeout - (loop.time() - start_time)
-                data = await asyncio.wait_for(
-                    loop.sock_recv(sock, 1024), timeout=local_timout
-                )
-                if data.startswith(DISCOVERY_RESPONSE_PREFIX):
-                    try:
-                        parts = data.decode().split("|")
-                        if len(parts) >= 3:
-                            server_id, ip = parts[1], parts[2]
-                            servers.append((ip, server_id))
-                    except Exception:
-                        pass
-            except asyncio.TimeoutError:
-                break
-            except OSError as e:
-                if hasattr(e, "winerror") and e.winerror == 10054:
-                    print("Reached WinError[10054]")
-                    pass
-                else:
-                    raise
-        sock.close()
-        return servers
-
-    async def choose_server(self):
-        my_ip = self.get_local_ip()
-        parts = my_ip.split(".")
-        broadcast = f"{parts[0]}.{parts[1]}.{parts[2]}.255"
-        local_task = asyncio.create_task(self.get_server_list("127.0.0.1"))
-        network_task = asyncio.create_task(self.get_server_list(broadcast))
-        local_servers, network_servers = await asyncio.gather(
-            local_task,
-            network_task,
-        )
-        if len(local_servers) == 1:
-            return local_servers[0][0]
-        if len(network_servers) == 1:
-            return network_servers[0][0]
-        gen_count = len(local_servers) + len(network_servers)
-        if gen_count == 0:
-            raise Exception("There is no servers")
-        else:
-            raise Exception("More than 1 server")
-
-    async def read(self):
-        message = (await self.reader.readline()).decode().strip()
-        if message == "":
-            raise Exception("server closed connection")
-        return message
-
-    async def write(self, message):
-        if not isinstance(message, str):
-            raise Exception(f"{message} isn't a string")
-        if not message:
-            raise Exception(f"message mustn't be clear")
-        self.writer.write(message.strip().encode() + b"\n")
-        await self.writer.drain()
-
-    async def create(self):
-        print(self.get_local_ip())
-        ip = await self.choose_server()
-        reader, writer = await asyncio.open_connection(ip, TCP_PORT)
-        self.reader = reader
-        self.writer = writer
-        init_message = await self.read()
-        if init_message != "ok":
-            raise Exception(init_message)
-        self.state = "connected"
-        print(f"connected to server {ip}:{TCP_PORT}")
-
-
 class game_client:
     def __init__(self):
         pygame.init()
         self.cell = 50
         self.clock = pygame.time.Clock()
+        self.font = pygame.font.Font(None, 20)
+        self.overlay_rect = None
+        self.frame_time = 0.0
+        self.prediction = None
+        self.prediction_rect = None
+        self.next_frame = 0.0
+        self.palette = None
+        if np is not None:
+            self.palette = np.zeros((256, 3), dtype=np.uint8)
+            for code, color in code_to_color.items():
+                self.palette[ord(code)] = color
 
     def resize(self, grid_size):
         self.width, self.height = grid_size
         new_size = (self.width * self.cell, self.height * self.cell)
         self.screen = pygame.display.set_mode(new_size)
+        self.board = pygame.Surface(new_size).convert()
+        self.sprites = self.build_sprites()
+        self.overlay_rect = None
+        self.prediction = None
+        self.prediction_rect = None
         self.screen.fill((255, 255, 255))
         pygame.display.flip()
 
-    def draw_grid(self, grid):
-        for x in range(self.width):
-            for y in range(self.height):
-                rect = pygame.Rect(x * self.cell, y * self.cell, self.cell, self.cell)
-                pygame.draw.rect(self.screen, code_to_color[grid[x][y]], rect)
-        pygame.display.flip()
+    def build_sprites(self):
+        sprites = {}
+        for code, color in code_to_color.items():
+            sprite = pygame.Surface((self.cell, self.cell)).convert()
+            sprite.fill(color)
+            sprites[ord(code)] = sprite
+        return sprites
 
-    def draw_delta(self, data):
-        for i in range(0, len(data), 3):
-            x, y, c = data[i : i + 3]
-            x -= BYTE_CODE_SHIFT
-            y -= BYTE_CODE_SHIFT
-            rect = pygame.Rect(x * self.cell, y * self.cell, self.cell, self.cell)
-            pygame.draw.rect(self.screen, code_to_color[chr(c)], rect)
+    def cell_pos(self, i: int):
+        return (i // self.height * self.cell, i % self.height * self.cell)
+
+    def draw_grid(self, cells):
+        time_start = time.perf_counter()
+        if self.palette is not None:
+            codes = np.frombuffer(cells, dtype=np.uint8)
+            colors = self.palette[codes.reshape(self.width, self.height)]
+            small = pygame.surfarray.make_surface(colors)
+            pygame.transform.scale(small, self.board.get_size(), self.board)
+        else:
+            sprites = [(self.sprites[c], self.cell_pos(i)) for i, c in enumerate(cells)]
+            self.board.blits(sprites, doreturn=False)
+        self.screen.blit(self.board, (0, 0))
+        self.prediction_rect = None
+        self.draw_overlay(time_start)
         pygame.display.flip()
 
+    def draw_delta(self, changes):
+        time_start = time.perf_counter()
+        rects = []
+        for i, c in changes:
+            pos = self.cell_pos(i)
+            self.board.blit(self.sprites[c], pos)
+            rects.append(self.screen.blit(self.sprites[c], pos))
+        rects += self.clear_prediction()
+        rects += self.draw_overlay(time_start)
+        pygame.display.update(rects)
+
+    def draw_overlay(self, time_start):
+        if not SHOW_FPS:
+            return []
+        self.clock.tick()
+        frame_time = time.perf_counter() - time_start
+        self.frame_time = 0.9 * self.frame_time + 0.1 * frame_time
+        rects = []
+        if self.overlay_rect:
+            self.screen.blit(self.board, self.overlay_rect, self.overlay_rect)
+            rects.append(self.overlay_rect)
+        fps = self.clock.get_fps()
+        text = f"{fps:.0f} fps, {self.frame_time * 1000:.2f} ms"
+        label = self.font.render(text, True, (255, 255, 255), (0, 0, 0))
+        self.overlay_rect = self.screen.blit(label, (4, 4))
+        rects.append(self.overlay_rect)
+        return rects
+
+    def predict(self, prediction):
+        self.prediction = prediction
+        if prediction is None:
+            pygame.display.update(self.clear_prediction())
+
+    def clear_prediction(self):
+        if self.prediction_rect is None:
+            return []
+        rect = self.prediction_rect
+        self.prediction_rect = None
+        self.screen.blit(self.board, rect, rect)
+        return [rect]
+
+    def draw_prediction(self):
+        rects = self.clear_prediction()
+        cell, dir, code, tick_at, interval = self.prediction
+        part = min(1.0, (time.perf_counter() - tick_at) / interval)
+        size = round(part * self.cell)
+        rect = pygame.Rect(self.cell_pos(cell), (self.cell, self.cell))
+        if dir == "R":
+            rect.width = size
+        elif dir == "L":
+            rect.left += self.cell - size
+            rect.width = size
+        elif dir == "D":
+            rect.height = size
+        else:
+            rect.top += self.cell - size
+            rect.height = size
+        self.prediction_rect = self.screen.fill(code_to_color[chr(code)], rect)
+        rects.append(self.prediction_rect)
+        return rects
+
+    def call(self, func, *args):
+        pygame.event.post(pygame.event.Event(CALL_EVENT, func=func, args=args))
+
+    def run(self, key_pressed):
+        while True:
+            event = pygame.event.wait(1000 // REFRESH_RATE if self.prediction else 0)
+            if event.type == pygame.QUIT:
+                return
+            elif event.type == CALL_EVENT:
+                event.func(*event.args)
+            elif event.type == pygame.KEYDOWN:
+                key_pressed(event.key, time.perf_counter())
+            now = time.perf_counter()
+            if self.prediction and now >= self.next_frame:
+                self.next_frame = now + 1 / REFRESH_RATE
+                pygame.display.update(self.draw_prediction())
+
     def get_dir(self):
         if len(self.que) == 0:
             return self.prev_dir
@@ -162,85 +185,231 @@ class game_client:
         self.que = self.que[1:]
         return self.prev_dir
 
-    async def create(self):
+    def create(self):
         self.resize((10, 10))
 
 
 class client:
-    def __init__(self):
-        self.network = network_client()
+    def __init__(self, role=None, keyframe=KEYFRAME_RLE):
+        self.network = network_client(role=role, keyframe=keyframe)
         self.display = game_client()
+        self.loop = None
+        self.input_latency = 0.0
+        self.num = None
+        self.has_bound = False
+        self.frame_turn = -1
+        self.steering = None
+        self.space_task = None
+
+    def init_grid(self, width, height, cells):
+        self.turn = 0
+        self.height = height
+        self.display.call(self.display.resize, point(width, height))
+        self.read_arrows = self.network.role is None
+        self.display.call(self.display.draw_grid, cells)
+        self.time = asyncio.get_event_loop().time()
+        self.tick_interval = None
+        self.init_steering(board(width, height, self.has_bound), cells)
+
+    def apply_delta(self, changes):
+        self.turn += 1
+        self.display.call(self.display.draw_delta, changes)
+        cur_time = asyncio.get_event_loop().time()
+        self.delta = cur_time - self.time
+        self.time = cur_time
+        self.tick_at = time.perf_counter()
+        if self.tick_interval is None:
+            self.tick_interval = self.delta
+        self.tick_interval = 0.8 * self.tick_interval + 0.2 * self.delta
+        self.reconcile(changes)
+
+    def init_steering(self, grid_board, cells):
+        self.board = grid_board
+        self.steering = None
+        if self.num is not None:
+            codes = snake_num_to_chr[f"snake {self.num}"]
+            self.head_code = ord(codes["head"])
+            self.head = cells.find(self.head_code)
+            if self.head != -1:
+                for steps in grid_board.steps.values():
+                    c = steps[self.head]
+                    if c != OUTSIDE and cells[c] == ord(codes["body"]):
+                        self.steering = steering(find_dir(grid_board, c, self.head))
+        self.predict()
+
+    def reconcile(self, changes):
+        if self.steering is None:
+            return
+        heads = [i for i, c in changes if c == self.head_code]
+        dir = None
+        if heads:
+            dir = find_dir(self.board, self.head, heads[0])
+        if dir is None:
+            self.steering = None
+        else:
+            self.steering.confirm_dir(dir)
+            self.head = heads[0]
+        self.predict()
+
+    def predict(self):
+        prediction = None
+        if self.steering is not None and self.tick_interval:
+            dir = self.steering.peek_dir()
+            cell = self.board.steps[dir][self.head]
+            if cell != OUTSIDE:
+                prediction = (
+                    cell,
+                    dir,
+                    self.head_code,
+                    self.tick_at,
+                    self.tick_interval,
+                )
+        self.display.call(self.display.predict, prediction)
 
     def parse_grid(self, message):
         blocks = message.split("|")
         if blocks[0] == "STATE_INIT":
-            self.turn = 0
             width = int(blocks[1])
             height = int(blocks[2])
-            grid = [p.split(",") for p in blocks[3].split(":")]
-            self.display.resize((width, height))
-            self.read_arrows = True
-            self.display.draw_grid(grid)
-            self.time = asyncio.get_event_loop().time()
+            cells = blocks[3].replace(",", "").replace(":", "").encode()
+            self.init_grid(width, height, cells)
+        else:
+            data = blocks[1].encode()
+            self.apply_delta(decode_text_delta(self.height, data))
+
+    def parse_frame(self, f: frame):
+        self.frame_turn = f.turn
+        if f.kind == STATE_INIT:
+            width, height, cells = decode_keyframe(f.payload, self.network.encoding)
+            self.init_grid(width, height, cells)
         else:
-            self.turn += 1
-            data = list(blocks[1].encode())
-            self.display.draw_delta(data)
-            cur_time = asyncio.get_event_loop().time()
-            self.delta = cur_time - self.time
-            self.time = cur_time
+            self.apply_delta(decode_delta(f.payload))
 
     async def space_await(self):
         self.space_pressed.clear()
         await self.space_pressed.wait()
 
+    async def answer_space(self):
+        await self.space_await()
+        await self.network.write("SPACE_PRESSED")
+
+    def key_pressed(self, key, pressed_at):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.keys.put_nowait, (key, pressed_at))
+
     async def event_handler(self):
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    exit(0)
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_SPACE:
-                        self.space_pressed.set()
-                    if event.key in key_to_dir and self.read_arrows:
-                        await self.network.write(key_to_dir[event.key])
-            await asyncio.sleep(0.01)
+            presses = [await self.keys.get()]
+            while not self.keys.empty():
+                presses.append(self.keys.get_nowait())
+            dirs = []
+            for key, pressed_at in presses:
+                if key == pygame.K_SPACE:
+                    self.space_pressed.set()
+                if key in key_to_dir and self.read_arrows:
+                    dirs.append(key_to_dir[key])
+                    if self.steering is not None:
+                        self.steering.apply_direct(key_to_dir[key])
+            if dirs:
+                self.predict()
+                await self.network.write_many(dirs)
+                self.input_latency = time.perf_counter() - presses[0][1]
+
+    def print_state(self):
+        latency = self.input_latency * 1000
+        print(f"STATE {self.turn}: {self.delta:.3f}, input -> send {latency:.1f} ms")
 
     async def handler(self):
         while True:
             message = await self.network.read()
+            if isinstance(message, frame):
+                self.parse_frame(message)
+                if message.kind == STATE_INIT:
+                    print("STATE_INIT")
+                else:
+                    self.print_state()
+                continue
             if message == "TEST":
                 await self.network.write("TEST_ANSWER")
             elif message == "SPACE_AWAIT":
-                await self.space_await()
-                await self.network.write("SPACE_PRESSED")
+                if self.space_task is not None:
+                    self.space_task.cancel()
+                self.space_task = asyncio.create_task(self.answer_space())
             elif message.startswith("STATE"):
                 self.parse_grid(message)
             elif message == "END_GAME":
                 self.read_arrows = False
+                self.steering = None
+                self.predict()
+            elif message.startswith("SESSION|") and self.network.resume_turn is None:
+                self.network.session = message.removeprefix("SESSION|")
+            elif message.startswith("YOU|"):
+                num, has_bound = message.split("|")[1:]
+                self.num = int(num)
+                self.has_bound = has_bound == "1"
             elif message == "PING":
                 await self.network.write("PONG")
+            elif message.startswith("PROTO|"):
+                await self.network.negotiate(message)
             if message.startswith("STATE|"):
-                print(f"STATE {self.turn}: {self.delta:.3f}")
+                self.print_state()
             elif message.startswith("STATE_INIT"):
                 print("STATE_INIT")
             else:
                 print(message)
 
     async def create(self):
-        await self.network.create()
-        await self.display.create()
         self.read_arrows = False
         self.space_pressed = asyncio.Event()
+        self.keys = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
         asyncio.create_task(self.event_handler())
-        await self.handler()
+        await self.network.create()
+        attempts = 0
+        while True:
+            try:
+                await self.handler()
+            except Exception as e:
+                if self.network.session is None or not self.read_arrows:
+                    raise
+                if attempts >= RESUME_ATTEMPTS:
+                    raise
+                attempts += 1
+                print(f"{repr(e)}, resuming session (attempt {attempts})")
+                await asyncio.sleep(RESUME_DELAY)
+                try:
+                    await self.network.resume(self.last_turn())
+                except Exception as e:
+                    print(f"resume failed: {repr(e)}")
+                    continue
+                attempts = 0
+
+    def last_turn(self):
+        if self.network.proto == PROTO_BINARY:
+            return self.frame_turn
+        return -1
+
+    def run_network(self):
+        try:
+            asyncio.run(self.create())
+        finally:
+            pygame.event.post(pygame.event.Event(pygame.QUIT))
 
 
-async def main():
-    a = client()
-    await a.create()
-    event = asyncio.Event()
-    await event.wait()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spectate", nargs="?", const="", metavar="ROOM")
+    parser.add_argument("--keyframe", choices=KEYFRAME_ENCODINGS, default=KEYFRAME_RLE)
+    args = parser.parse_args()
+    role = None
+    if args.spectate is not None:
+        role = f"spectator|{args.spectate}" if args.spectate else "spectator"
+    a = client(role, args.keyframe)
+    a.display.create()
+    threading.Thread(target=a.run_network, daemon=True).start()
+    a.display.run(a.key_pressed)
+    pygame.quit()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from array import array
+from collections import namedtuple
+
+OUTSIDE = -1
+
+
+class point(namedtuple("point", ["x", "y"])):
+    __slots__ = ()
+
+    def __new__(cls, x=0, y=0):
+        return super().__new__(cls, x, y)
+
+    def in_bound(self, width, height):
+        return (0 <= self.x and self.x < width) and (0 <= self.y and self.y < height)
+
+    def __add__(self, other):
+        return point(self.x + other.x, self.y + other.y)
+
+    def __sub__(self, other):
+        return point(self.x - other.x, self.y - other.y)
+
+
+dir_to_ds = {
+    "L": point(-1, 0),
+    "R": point(1, 0),
+    "D": point(0, 1),
+    "U": point(0, -1),
+}
+
+
+def collinear_dir(dir1, dir2):
+    a = {"U", "D"}
+    b = {"L", "R"}
+    if dir1 in a and dir2 in a:
+        return True
+    if dir1 in b and dir2 in b:
+        return True
+    return False
+
+
+class board:
+    def __init__(self, width, height, has_bound):
+        self.width = width
+        self.height = height
+        self.has_bound = has_bound
+        self.size = width * height
+        self.steps = {dir: self.build_steps(ds) for dir, ds in dir_to_ds.items()}
+
+    def wrap(self, v, n):
+        if 0 <= v < n:
+            return v
+        if self.has_bound:
+            return OUTSIDE
+        return v % n
+
+    def build_steps(self, ds: point):
+        ys = [self.wrap(y + ds.y, self.height) for y in range(self.height)]
+        steps = array("i")
+        for x in range(self.width):
+            nx = self.wrap(x + ds.x, self.width)
+            if nx == OUTSIDE:
+                steps.extend([OUTSIDE] * self.height)
+            else:
+                steps.extend(
+                    OUTSIDE if ny == OUTSIDE else nx * self.height + ny for ny in ys
+                )
+        return steps
+
+    def index(self, p: point):
+        if not p.in_bound(self.width, self.height):
+            return OUTSIDE
+        return p.x * self.height + p.y
@@ -0,0 +1,74 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+CATEGORIES = ("io", "udp", "room", "tick", "server", "game")
+FORMAT = "%(asctime)s.%(msecs)03d %(levelname).1s %(name)s: %(message)s"
+DATE_FORMAT = "%H:%M:%S"
+
+settings = {}
+
+
+def get(category):
+    return logging.getLogger(f"snake.{category}")
+
+
+def parse_pairs(text, cast=float):
+    pairs = {}
+    for item in filter(None, text.split(",")):
+        key, value = item.split("=")
+        pairs[key] = cast(value)
+    return pairs
+
+
+class limiter(logging.Filter):
+    def __init__(self, sample=1.0, rate=None):
+        super().__init__()
+        self.every = round(1 / sample) if sample > 0 else 0
+        self.rate = rate
+        self.seen = 0
+        self.window = 0
+        self.passed = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        self.seen += 1
+        if self.every == 0 or (self.seen - 1) % self.every != 0:
+            return False
+        if self.rate is None:
+            return True
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.passed = 0
+            if self.suppressed:
+                record.msg = f"[{self.suppressed} suppressed] {record.msg}"
+                self.suppressed = 0
+        if self.passed >= self.rate:
+            self.suppressed += 1
+            return False
+        self.passed += 1
+        return True
+
+
+def setup(level="INFO", debug=(), sample=None, rate=None):
+    sample = sample or {}
+    rate = rate or {}
+    settings.update(level=level, debug=debug, sample=sample, rate=rate)
+    root = logging.getLogger("snake")
+    root.setLevel(level)
+    root.propagate = False
+    records = queue.SimpleQueue()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    for category in CATEGORIES:
+        logger = get(category)
+        logger.setLevel(logging.DEBUG if category in debug else logging.NOTSET)
+        logger.filters = [limiter(sample.get(category, 1.0), rate.get(category))]
@@ -0,0 +1,258 @@
+import asyncio
+from bisect import bisect_left
+from collections import deque
+import log
+
+server_log = log.get("server")
+
+BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+JITTER_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+)
+PHASES = (
+    "tick",
+    "make_turn",
+    "gen_apples",
+    "get_delta",
+    "encode",
+    "write_all",
+    "publish",
+)
+
+
+class histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.sum / self.count
+
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+        return 0.0
+
+    def render(self, name, labels):
+        lines = []
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def ms(seconds):
+    return f"{seconds * 1000:.3f}"
+
+
+class tick_metrics:
+    def __init__(self):
+        self.phases = {phase: histogram() for phase in PHASES}
+        self.jitter = histogram(JITTER_BUCKETS)
+        self.skipped = 0
+        self.match = None
+
+    def start_match(self):
+        self.match = tick_metrics()
+
+    def observe(self, phase, seconds):
+        self.phases[phase].observe(seconds)
+        if self.match:
+            self.match.observe(phase, seconds)
+
+    def observe_jitter(self, seconds):
+        self.jitter.observe(seconds)
+        if self.match:
+            self.match.observe_jitter(seconds)
+
+    def skip(self, ticks):
+        self.skipped += ticks
+        if self.match:
+            self.match.skip(ticks)
+
+    def last(self):
+        return ", ".join(f"{p} {ms(h.last)}" for p, h in self.phases.items())
+
+    def summary(self):
+        parts = []
+        for phase, h in self.phases.items():
+            stats = f"{ms(h.mean())}/{ms(h.quantile(0.99))}/{ms(h.max)}"
+            parts.append(f"{phase} {stats}")
+        h = self.jitter
+        parts.append(f"jitter {ms(h.mean())}/{ms(h.quantile(0.99))}/{ms(h.max)}")
+        parts.append(f"skipped {self.skipped}")
+        return "phases mean/p99/max ms: " + ", ".join(parts)
+
+
+class latency:
+    def __init__(self, alpha=0.125, beta=0.25):
+        self.alpha = alpha
+        self.beta = beta
+        self.sent = deque()
+        self.rtt = None
+        self.jitter = 0.0
+        self.held = 0.0
+        self.samples = histogram()
+
+    def ping(self, now):
+        self.sent.append(now)
+
+    def pong(self, now):
+        if not self.sent:
+            return None
+        sent = self.sent.popleft()
+        if sent < self.held:
+            return None
+        sample = now - sent
+        if self.rtt is None:
+            self.rtt = sample
+            self.jitter = sample / 2
+        else:
+            self.jitter += self.beta * (abs(sample - self.rtt) - self.jitter)
+            self.rtt += self.alpha * (sample - self.rtt)
+        self.samples.observe(sample)
+        return sample
+
+    def hold(self, now):
+        self.held = now
+
+    def overdue(self, now, timeout):
+        return len(self.sent) > 0 and now - max(self.sent[0], self.held) > timeout
+
+    def summary(self):
+        if self.rtt is None:
+            return "rtt unknown"
+        return f"rtt {ms(self.rtt)} ms, jitter {ms(self.jitter)} ms"
+
+
+class client_stats:
+    def __init__(self):
+        self.write_time = histogram()
+        self.bytes = 0
+        self.latency = latency()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.dropped = 0
+
+    def observe(self, seconds, size):
+        self.write_time.observe(seconds)
+        self.bytes += size
+
+    def queued(self, depth):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def summary(self):
+        h = self.write_time
+        p99 = ms(h.quantile(0.99))
+        writes = f"{self.bytes} bytes in {h.count} writes, write p99 {p99} ms"
+        queue = f"queue max {self.max_queue_depth}, {self.dropped} dropped"
+        return f"{writes}, {queue}, {self.latency.summary()}"
+
+
+def render(rooms, clients):
+    lines = ["# TYPE snake_tick_phase_seconds histogram"]
+    for labels, m in rooms:
+        for phase, h in m.phases.items():
+            phase_labels = f'{labels},phase="{phase}"'
+            lines += h.render("snake_tick_phase_seconds", phase_labels)
+    lines.append("# TYPE snake_tick_jitter_seconds histogram")
+    for labels, m in rooms:
+        lines += m.jitter.render("snake_tick_jitter_seconds", labels)
+    lines.append("# TYPE snake_tick_skipped_total counter")
+    for labels, m in rooms:
+        lines.append(f"snake_tick_skipped_total{{{labels}}} {m.skipped}")
+    lines.append("# TYPE snake_client_write_seconds histogram")
+    for labels, stats in clients:
+        lines += stats.write_time.render("snake_client_write_seconds", labels)
+    lines.append("# TYPE snake_client_sent_bytes_total counter")
+    for labels, stats in clients:
+        lines.append(f"snake_client_sent_bytes_total{{{labels}}} {stats.bytes}")
+    lines.append("# TYPE snake_client_queue_depth gauge")
+    for labels, stats in clients:
+        lines.append(f"snake_client_queue_depth{{{labels}}} {stats.queue_depth}")
+    lines.append("# TYPE snake_client_dropped_frames_total counter")
+    for labels, stats in clients:
+        lines.append(f"snake_client_dropped_frames_total{{{labels}}} {stats.dropped}")
+    for name in ("rtt", "jitter"):
+        lines.append(f"# TYPE snake_client_{name}_seconds gauge")
+        for labels, stats in clients:
+            if stats.latency.rtt is not None:
+                value = getattr(stats.latency, name)
+                lines.append(f"snake_client_{name}_seconds{{{labels}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def serve(port, collect):
+    async def handler(reader, writer):
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=1.0)
+                if line in (b"", b"\r\n", b"\n"):
+                    break
+        except Exception:
+            pass
+        body = collect().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    metrics_server = await asyncio.start_server(handler, host="127.0.0.1", port=port)
+    server_log.info("metrics endpoint started at 127.0.0.1:%s", port)
+    await metrics_server.serve_forever()
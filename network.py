@@ -0,0 +1,183 @@
+import asyncio
+import socket
+from protocol import (
+    KEYFRAME_RAW,
+    KEYFRAME_RLE,
+    MSG,
+    PROTO_BINARY,
+    PROTO_TEXT,
+    encode_frame,
+    read_frame,
+    split_format,
+)
+
+TCP_PORT = 8888
+UDP_PORT = 9999
+DISCOVERY_REQUEST = b"DISCOVER_SNAKE_GAME"
+DISCOVERY_RESPONSE_PREFIX = b"SNAKE_GAME_HERE"
+
+
+def get_local_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+class network_client:
+    def __init__(
+        self,
+        preferred_proto=PROTO_BINARY,
+        role=None,
+        verbose=True,
+        keyframe=KEYFRAME_RLE,
+    ):
+        self.state = "disconnected"
+        self.verbose = verbose
+        self.port = TCP_PORT
+        self.reader = None
+        self.writer = None
+        self.proto = PROTO_TEXT
+        self.preferred_proto = preferred_proto
+        self.keyframe = keyframe
+        self.encoding = KEYFRAME_RAW
+        self.role = role
+        self.session = None
+        self.resume_turn = None
+
+    async def get_server_list(self, broadcast_addr, timeout=2.0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setblocking(False)
+
+        loop = asyncio.get_event_loop()
+        print(f"browsing servers on {broadcast_addr} ...")
+        await loop.run_in_executor(
+            None,
+            sock.sendto,
+            DISCOVERY_REQUEST,
+            (broadcast_addr, UDP_PORT),
+        )
+        servers = []
+        start_time = loop.time()
+        while loop.time() - start_time < timeout:
+            try:
+                local_timout = timeout - (loop.time() - start_time)
+                data = await asyncio.wait_for(
+                    loop.sock_recv(sock, 1024), timeout=local_timout
+                )
+                if data.startswith(DISCOVERY_RESPONSE_PREFIX):
+                    try:
+                        parts = data.decode().split("|")
+                        if len(parts) >= 3:
+                            server_id, ip = parts[1], parts[2]
+                            load = int(parts[3]) if len(parts) >= 4 else None
+                            servers.append((ip, server_id, load))
+                    except Exception:
+                        pass
+            except asyncio.TimeoutError:
+                break
+            except OSError as e:
+                if hasattr(e, "winerror") and e.winerror == 10054:
+                    print("Reached WinError[10054]")
+                    pass
+                else:
+                    raise
+        sock.close()
+        return servers
+
+    async def choose_server(self):
+        my_ip = get_local_ip()
+        parts = my_ip.split(".")
+        broadcast = f"{parts[0]}.{parts[1]}.{parts[2]}.255"
+        local_task = asyncio.create_task(self.get_server_list("127.0.0.1"))
+        network_task = asyncio.create_task(self.get_server_list(broadcast))
+        local_servers, network_servers = await asyncio.gather(
+            local_task,
+            network_task,
+        )
+        if len(local_servers) == 1:
+            return local_servers[0][0]
+        if len(network_servers) == 1:
+            return network_servers[0][0]
+        servers = {server_id: (ip, load) for ip, server_id, load in local_servers}
+        for ip, server_id, load in network_servers:
+            servers.setdefault(server_id, (ip, load))
+        if len(servers) == 0:
+            raise Exception("There is no servers")
+        if any(load is None for ip, load in servers.values()):
+            raise Exception("More than 1 server")
+        ip, load = min(servers.values(), key=lambda server: server[1])
+        print(f"choosing the least loaded server {ip} (load = {load})")
+        return ip
+
+    async def read(self):
+        if self.proto == PROTO_BINARY:
+            try:
+                f = await read_frame(self.reader)
+            except asyncio.IncompleteReadError:
+                raise Exception("server closed connection")
+            if f.kind != MSG:
+                return f
+            return f.payload.decode().strip()
+        message = (await self.reader.readline()).decode().strip()
+        if message == "":
+            raise Exception("server closed connection")
+        return message
+
+    def encode(self, message):
+        if not isinstance(message, str):
+            raise Exception(f"{message} isn't a string")
+        if not message:
+            raise Exception(f"message mustn't be clear")
+        if self.proto == PROTO_BINARY:
+            return encode_frame(MSG, 0, message.strip().encode())
+        return message.strip().encode() + b"\n"
+
+    async def write(self, message):
+        self.writer.write(self.encode(message))
+        await self.writer.drain()
+
+    async def write_many(self, messages):
+        self.writer.write(b"".join(self.encode(message) for message in messages))
+        await self.writer.drain()
+
+    async def negotiate(self, message):
+        offered = message.removeprefix("PROTO|").split(",")
+        if self.preferred_proto in offered:
+            format = self.preferred_proto
+            if f"{format}+{self.keyframe}" in offered:
+                format = f"{format}+{self.keyframe}"
+            answer = f"PROTO|{format}"
+            if self.role:
+                answer += f"|{self.role}"
+            elif self.resume_turn is not None:
+                answer += f"|RESUME|{self.session}|{self.resume_turn}"
+                self.resume_turn = None
+            await self.write(answer)
+            self.proto, self.encoding = split_format(format)
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.ip, self.port)
+        self.reader = reader
+        self.writer = writer
+        self.proto = PROTO_TEXT
+        self.encoding = KEYFRAME_RAW
+        init_message = await self.read()
+        if init_message != "ok":
+            raise Exception(init_message)
+        self.state = "connected"
+        if self.verbose:
+            print(f"connected to server {self.ip}:{self.port}")
+
+    async def resume(self, turn):
+        self.writer.close()
+        self.resume_turn = turn
+        await self.connect()
+
+    async def create(self):
+        print(get_local_ip())
+        self.ip = await self.choose_server()
+        await self.connect()
@@ -0,0 +1,267 @@
+import re
+import struct
+import zlib
+from collections import namedtuple
+
+BYTE_CODE_SHIFT = 100
+TEXT_MAX_SIZE = 128 - BYTE_CODE_SHIFT
+PROTO_TEXT = "text"
+PROTO_BINARY = "binary"
+PROTOCOLS = [PROTO_BINARY, PROTO_TEXT]
+PROTO_TIMEOUT = 1.0
+KEYFRAME_RAW = "raw"
+KEYFRAME_RLE = "rle"
+KEYFRAME_ZLIB = "zlib"
+KEYFRAME_ENCODINGS = [KEYFRAME_ZLIB, KEYFRAME_RLE, KEYFRAME_RAW]
+FORMATS = [
+    f"{PROTO_BINARY}+{KEYFRAME_ZLIB}",
+    f"{PROTO_BINARY}+{KEYFRAME_RLE}",
+    PROTO_BINARY,
+    PROTO_TEXT,
+]
+ZLIB_LEVEL = 6
+ZLIB_DICT = b"AcCdD" + b"." * 1024
+RUN_CODES = b".cCdDA"
+RUN = re.compile(
+    b"|".join(re.escape(bytes([c])) + b"+" for c in RUN_CODES) + rb"|(.)\1*",
+    re.DOTALL,
+)
+
+MSG = 0
+STATE_INIT = 1
+STATE = 2
+
+HEADER = struct.Struct("!IBI")
+MAX_PAYLOAD = 1 << 26
+
+frame = namedtuple("frame", ["kind", "turn", "payload"])
+
+
+def encode_varint(n: int, out: bytearray):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(data, pos: int):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def encode_frame(kind: int, turn: int, payload) -> bytes:
+    return HEADER.pack(len(payload), kind, turn) + payload
+
+
+async def read_frame(reader) -> frame:
+    length, kind, turn = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise Exception(f"frame is too long ({length} bytes)")
+    return frame(kind, turn, await reader.readexactly(length))
+
+
+def split_format(format: str):
+    proto, _, encoding = format.partition("+")
+    return proto, encoding or KEYFRAME_RAW
+
+
+def encode_rle(width: int, height: int, cells, out: bytearray):
+    for x in range(width):
+        for run in RUN.finditer(cells, x * height, (x + 1) * height):
+            encode_varint(run.end() - run.start(), out)
+            out.append(cells[run.start()])
+
+
+def decode_rle(payload, pos: int, width: int, height: int) -> bytearray:
+    cells = bytearray(width * height)
+    i = 0
+    while i < len(cells):
+        n, pos = decode_varint(payload, pos)
+        cells[i : i + n] = payload[pos : pos + 1] * n
+        pos += 1
+        i += n
+    return cells
+
+
+def encode_zlib(cells) -> bytes:
+    compressor = zlib.compressobj(ZLIB_LEVEL, zdict=ZLIB_DICT)
+    return compressor.compress(cells) + compressor.flush()
+
+
+def decode_zlib(payload, pos: int) -> bytes:
+    decompressor = zlib.decompressobj(zdict=ZLIB_DICT)
+    return decompressor.decompress(payload[pos:]) + decompressor.flush()
+
+
+def encode_keyframe(width: int, height: int, cells, encoding=KEYFRAME_RAW) -> bytes:
+    out = bytearray()
+    encode_varint(width, out)
+    encode_varint(height, out)
+    if encoding == KEYFRAME_RLE:
+        encode_rle(width, height, cells, out)
+    elif encoding == KEYFRAME_ZLIB:
+        out += encode_zlib(cells)
+    else:
+        out += cells
+    return bytes(out)
+
+
+def decode_keyframe(payload, encoding=KEYFRAME_RAW):
+    width, pos = decode_varint(payload, 0)
+    height, pos = decode_varint(payload, pos)
+    if encoding == KEYFRAME_RLE:
+        cells = decode_rle(payload, pos, width, height)
+    elif encoding == KEYFRAME_ZLIB:
+        cells = decode_zlib(payload, pos)
+    else:
+        cells = payload[pos : pos + width * height]
+    if len(cells) != width * height:
+        raise Exception("keyframe is truncated")
+    return width, height, cells
+
+
+def encode_delta(changes) -> bytes:
+    out = bytearray()
+    for i, code in changes:
+        encode_varint(i, out)
+        out.append(code)
+    return bytes(out)
+
+
+def decode_delta(payload):
+    changes = []
+    pos = 0
+    while pos < len(payload):
+        i, pos = decode_varint(payload, pos)
+        changes.append((i, payload[pos]))
+        pos += 1
+    return changes
+
+
+def text_fits(width: int, height: int) -> bool:
+    return max(width, height) <= TEXT_MAX_SIZE
+
+
+def encode_text_keyframe(width: int, height: int, cells) -> str:
+    text = cells.decode()
+    columns = [",".join(text[x * height : (x + 1) * height]) for x in range(width)]
+    return f"{width}|{height}|{':'.join(columns)}"
+
+
+def encode_text_delta(height: int, changes) -> str:
+    res = bytearray()
+    for i, code in changes:
+        res.append(i // height + BYTE_CODE_SHIFT)
+        res.append(i % height + BYTE_CODE_SHIFT)
+        res.append(code)
+    return res.decode()
+
+
+def decode_text_delta(height: int, data: bytes):
+    changes = []
+    for i in range(0, len(data), 3):
+        x, y, code = data[i : i + 3]
+        changes.append(((x - BYTE_CODE_SHIFT) * height + y - BYTE_CODE_SHIFT, code))
+    return changes
+
+
+class frame_writer:
+    def __init__(self, capacity=1 << 16):
+        self.buf = bytearray(capacity)
+        self.pos = 0
+        self.separators = {}
+
+    def reserve(self, n):
+        if self.pos + n > len(self.buf):
+            size = max(self.pos + n, 2 * len(self.buf))
+            self.buf += bytes(size - len(self.buf))
+
+    def write(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self.reserve(len(data))
+        self.buf[self.pos : end] = data
+        self.pos = end
+
+    def begin_frame(self):
+        start = self.pos
+        self.reserve(HEADER.size)
+        self.pos += HEADER.size
+        return start
+
+    def end_frame(self, start, kind, turn):
+        length = self.pos - start - HEADER.size
+        HEADER.pack_into(self.buf, start, length, kind, turn)
+
+    def varint(self, n):
+        self.reserve(10)
+        buf, pos = self.buf, self.pos
+        while n >= 0x80:
+            buf[pos] = (n & 0x7F) | 0x80
+            pos += 1
+            n >>= 7
+        buf[pos] = n
+        self.pos = pos + 1
+
+    def keyframe(self, width, height, cells, encoding=KEYFRAME_RAW):
+        self.varint(width)
+        self.varint(height)
+        if encoding == KEYFRAME_RLE:
+            runs = bytearray()
+            encode_rle(width, height, cells, runs)
+            self.write(runs)
+        elif encoding == KEYFRAME_ZLIB:
+            self.write(encode_zlib(cells))
+        else:
+            self.write(cells)
+
+    def delta(self, changes):
+        self.reserve(len(changes) * 11)
+        buf, pos = self.buf, self.pos
+        for i, code in changes:
+            while i >= 0x80:
+                buf[pos] = (i & 0x7F) | 0x80
+                pos += 1
+                i >>= 7
+            buf[pos] = i
+            buf[pos + 1] = code
+            pos += 2
+        self.pos = pos
+
+    def text_keyframe(self, width, height, cells):
+        self.write(f"{width}|{height}|".encode())
+        n = width * height
+        if n == 0:
+            return
+        key = (width, height)
+        if key not in self.separators:
+            separators = bytearray(b",") * (n - 1)
+            separators[height - 1 :: height] = b":" * (width - 1)
+            self.separators[key] = bytes(separators)
+        end = self.pos + 2 * n - 1
+        self.reserve(2 * n - 1)
+        self.buf[self.pos : end : 2] = cells
+        self.buf[self.pos + 1 : end : 2] = self.separators[key]
+        self.pos = end
+
+    def text_delta(self, height, changes):
+        self.reserve(len(changes) * 3)
+        buf, pos = self.buf, self.pos
+        for i, code in changes:
+            buf[pos] = i // height + BYTE_CODE_SHIFT
+            buf[pos + 1] = i % height + BYTE_CODE_SHIFT
+            buf[pos + 2] = code
+            pos += 3
+        self.pos = pos
+
+    def snapshot(self):
+        data = bytes(memoryview(self.buf)[: self.pos])
+        self.pos = 0
+        return memoryview(data)
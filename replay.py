@@ -0,0 +1,67 @@
+import argparse
+import json
+import time
+from geometry import dir_to_ds
+
+DIRS = list(dir_to_ds)
+TURN_END = 0xFF
+SETTINGS = ["width", "height", "players_number", "apples_number", "has_bound"]
+
+
+class replay_writer:
+    def __init__(self, path, header: dict):
+        self.file = open(path, "xb")
+        self.file.write(json.dumps(header).encode() + b"\n")
+
+    def input(self, num: int, dir: str):
+        self.file.write(bytes([num << 2 | DIRS.index(dir)]))
+
+    def turn(self):
+        self.file.write(bytes([TURN_END]))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_replay(path):
+    with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        events = f.read()
+    return header, events
+
+
+def replay(path, turn=None):
+    from server import game
+
+    header, events = read_replay(path)
+    g = game()
+    for key in SETTINGS + ["turn_time"]:
+        setattr(g, key, header[key])
+    g.build_start_pos(header["seed"])
+    played = 0
+    for e in events:
+        if e == TURN_END:
+            if turn is not None and played >= turn:
+                break
+            g.make_turn()
+            played += 1
+        else:
+            g.snakes[e >> 2].apply_direct(DIRS[e & 3])
+    return g, played
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--turn", type=int, default=None)
+    args = parser.parse_args()
+    import server  # imported before timing so only the rebuild is measured
+
+    time_start = time.perf_counter()
+    g, played = replay(args.path, args.turn)
+    elapsed = time.perf_counter() - time_start
+    grid = g.construc_grid().decode()
+    for y in range(g.height):
+        print("".join(grid[x * g.height + y] for x in range(g.width)))
+    print(f"turn {played} (end_game = {g.end_game}) rebuilt in {elapsed * 1000:.1f} ms")
@@ -0,0 +1,126 @@
+import random
+from collections import Counter, deque
+from geometry import OUTSIDE, board, collinear_dir, dir_to_ds, point
+
+
+def find_dir(board: board, src: int, dst: int):
+    for dir, steps in board.steps.items():
+        if steps[src] == dst:
+            return dir
+    return None
+
+
+class steering:
+    def __init__(self, prev_dir):
+        self.prev_dir = prev_dir
+        self.que = deque()
+
+    def apply_direct(self, ndir):
+        pdir = self.prev_dir
+        if len(self.que) > 0:
+            pdir = self.que[-1]
+        if not collinear_dir(pdir, ndir) and len(self.que) < 3:
+            self.que.append(ndir)
+
+    def peek_dir(self):
+        if len(self.que) > 0:
+            return self.que[0]
+        return self.prev_dir
+
+    def next_dir(self):
+        self.prev_dir = self.peek_dir()
+        if len(self.que) > 0:
+            self.que.popleft()
+        return self.prev_dir
+
+    def confirm_dir(self, dir):
+        if len(self.que) > 0 and self.que[0] == dir:
+            self.que.popleft()
+        elif dir != self.prev_dir:
+            self.que.clear()
+        self.prev_dir = dir
+
+
+snake_num_to_chr = {
+    "apple": "A",
+    "snake 0": {"body": "c", "head": "C"},
+    "snake 1": {"body": "d", "head": "D"},
+}
+
+
+class snake(steering):
+    def __init__(self, body: list[point], num: int, board: board):
+        self.num = num
+        self.board = board
+        prev_dir = ""
+        for key, val in dir_to_ds.items():
+            if val == body[-1] - body[-2]:
+                prev_dir = key
+        if prev_dir == "":
+            raise Exception("Incorrect init snake")
+        super().__init__(prev_dir)
+        self.body = deque(board.index(p) for p in body)
+        self.cells = Counter(self.body)
+
+    def add_occupancy(self, occupancy):
+        self.occupancy = occupancy
+        for c in self.body:
+            occupancy.add(c)
+
+    def add_changelog(self, changelog: list):
+        self.changelog = changelog
+
+    def make_turn(self, apples):
+        dir = self.next_dir()
+        head = self.body[-1]
+        c = self.board.steps[dir][head]
+        self.body.append(c)
+        self.cells[c] += 1
+        self.occupancy.add(c)
+        self.changelog.append(head)
+        self.changelog.append(c)
+        if c not in apples:
+            tail = self.body.popleft()
+            self.cells[tail] -= 1
+            if self.cells[tail] == 0:
+                del self.cells[tail]
+            self.occupancy.remove(tail)
+            self.changelog.append(tail)
+
+
+class occupancy:
+    def __init__(self, board: board):
+        self.board = board
+        self.cells = bytearray(board.size)
+        self.free = list(range(board.size))
+        self.free_pos = list(range(board.size))
+
+    def count(self, i: int):
+        if i == OUTSIDE:
+            return 0
+        return self.cells[i]
+
+    def add(self, i: int):
+        if i == OUTSIDE:
+            return
+        if self.cells[i] == 0:
+            pos = self.free_pos[i]
+            last = self.free.pop()
+            if last != i:
+                self.free[pos] = last
+                self.free_pos[last] = pos
+            self.free_pos[i] = -1
+        self.cells[i] += 1
+
+    def remove(self, i: int):
+        if i == OUTSIDE:
+            return
+        self.cells[i] -= 1
+        if self.cells[i] == 0:
+            self.free_pos[i] = len(self.free)
+            self.free.append(i)
+
+    def random_free(self, rng: random.Random):
+        if len(self.free) == 0:
+            return None
+        return rng.choice(self.free)
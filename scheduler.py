@@ -0,0 +1,67 @@
+import asyncio
+
+POLICIES = ("catch_up", "skip", "adaptive")
+TIMERS = ("sleep", "call_at")
+MAX_CATCH_UP = 3
+RTT_FACTOR = 2.0
+
+
+class scheduler:
+    def __init__(self, loop, turn_time, start, policy="catch_up", timer="sleep"):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown tick policy {policy}")
+        if timer not in TIMERS:
+            raise ValueError(f"unknown tick timer {timer}")
+        self.loop = loop
+        self.turn_time = turn_time
+        self.interval = turn_time
+        self.deadline = start
+        self.policy = policy
+        self.timer = timer
+        self.max_catch_up = MAX_CATCH_UP
+        self.skipped = 0
+        self.lag = 0.0
+
+    async def sleep_until(self, deadline):
+        future = self.loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        handle = self.loop.call_at(deadline, wake)
+        try:
+            await future
+        finally:
+            handle.cancel()
+
+    async def wait(self):
+        delay = self.deadline - self.loop.time()
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return None
+        if self.timer == "call_at":
+            await self.sleep_until(self.deadline)
+        else:
+            await asyncio.sleep(delay)
+        return self.loop.time() - self.deadline
+
+    def advance(self, now, rtt=0.0):
+        if self.policy == "adaptive":
+            self.interval = max(self.turn_time, RTT_FACTOR * rtt)
+        self.deadline += self.interval
+        behind = now - self.deadline
+        self.lag = max(0.0, behind)
+        if behind <= 0:
+            return 0
+        if self.policy == "adaptive":
+            self.deadline = now
+            return 0
+        missed = int(behind // self.interval) + 1
+        if self.policy == "catch_up":
+            missed -= self.max_catch_up
+        if missed <= 0:
+            return 0
+        self.deadline += missed * self.interval
+        self.skipped += missed
+        return missed
@@ -1,290 +1,367 @@
+import argparse
 import configparser
 import asyncio
+import logging
+import multiprocessing
 import random
 import socket
+import os
+import threading
+import time
 import uuid
+from collections import deque
+import log
+from geometry import OUTSIDE, board, dir_to_ds, point
+from protocol import (
+    MSG,
+    PROTO_BINARY,
+    PROTO_TEXT,
+    PROTO_TIMEOUT,
+    FORMATS,
+    STATE,
+    STATE_INIT,
+    encode_frame,
+    encode_text_delta,
+    encode_text_keyframe,
+    frame_writer,
+    read_frame,
+    split_format,
+    text_fits,
+)
+from metrics import client_stats, render, serve, tick_metrics
+from network import (
+    DISCOVERY_REQUEST,
+    DISCOVERY_RESPONSE_PREFIX,
+    TCP_PORT,
+    UDP_PORT,
+    get_local_ip,
+)
+from replay import SETTINGS, replay_writer
+from rules import occupancy, snake, snake_num_to_chr
+from scheduler import POLICIES, TIMERS, scheduler
 
 SERVER_ID = f"snake_game_server-{uuid.uuid4().hex[:8]}"
-TCP_PORT = 8888
-UDP_PORT = 9999
-DISCOVERY_REQUEST = b"DISCOVER_SNAKE_GAME"
-DISCOVERY_RESPONSE_PREFIX = b"SNAKE_GAME_HERE"
 CONFIG_PATH = "config.ini"
-BYTE_CODE_SHIFT = 100
-
-
-def get_local_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        return s.getsockname()[0]
-    finally:
-        s.close()
-
-
-async def udp_responder():
+CONFIG_POLL_INTERVAL = 1.0
+CONFIG_GETTERS = {
+    "width": "getint",
+    "height": "getint",
+    "players_number": "getint",
+    "turn_time": "getfloat",
+    "apples_number": "getint",
+    "has_bound": "getboolean",
+    "tick_policy": "get",
+    "tick_timer": "get",
+}
+CONFIG_DEFAULTS = {"tick_policy": "catch_up", "tick_timer": "sleep"}
+DEBUG_DELTA = False
+SEND_QUEUE_SIZE = 8
+SLOW_CLIENT_POLICY = "coalesce"
+MAX_ROOMS = 256
+TICK_SLOTS = 16
+LOAD_REPORT_INTERVAL = 1.0
+RECORD_REPLAYS = True
+REPLAY_DIR = "replays"
+KEYFRAME_TURNS = 50
+RESUME_TIMEOUT = 10.0
+METRICS_PORT = None
+TEXT_REFUSED = "Board is too big for the text protocol"
+ROOM_FULL = "Room is full"
+
+io_log = log.get("io")
+udp_log = log.get("udp")
+room_log = log.get("room")
+tick_log = log.get("tick")
+server_log = log.get("server")
+game_log = log.get("game")
+FANOUT_BATCH = 256
+REPLIES = ("SPACE_PRESSED",)
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 5.0
+
+
+async def udp_responder(get_load):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setblocking(False)
     sock.bind(("0.0.0.0", UDP_PORT))
 
     local_ip = get_local_ip()
     loop = asyncio.get_event_loop()
-    print(f"Server {SERVER_ID} is waiting for UPD-requests on port {UDP_PORT}")
+    udp_log.info(
+        "Server %s is waiting for UPD-requests on port %s", SERVER_ID, UDP_PORT
+    )
 
     while True:
         try:
             data, addr = await loop.sock_recvfrom(sock, 1024)
-            print(f"UDP get {data} from {addr}")
+            udp_log.debug("UDP get %s from %s", data, addr)
             if data == DISCOVERY_REQUEST:
-                response = f"{DISCOVERY_RESPONSE_PREFIX.decode()}|{SERVER_ID}|{local_ip}".encode()
+                prefix = DISCOVERY_RESPONSE_PREFIX.decode()
+                response = f"{prefix}|{SERVER_ID}|{local_ip}|{get_load()}".encode()
                 await loop.sock_sendto(sock, response, addr)
         except Exception as e:
-            print(f"Error in UDP: {repr(e)}")
+            udp_log.warning("Error in UDP: %r", e)
 
 
-def load_config(path="config.ini"):
-    config = configparser.ConfigParser()
-    config.read(path, encoding="utf-8")
+def read_section(section):
     return {
-        "game": {
-            "width": config.getint("game", "width"),
-            "height": config.getint("game", "height"),
-            "players_number": config.getint("game", "players_number"),
-            "turn_time": config.getfloat("game", "turn_time"),
-            "apples_number": config.getint("game", "apples_number"),
-            "has_bound": config.getboolean("game", "has_bound"),
-        }
+        key: getattr(section, getter)(key)
+        for key, getter in CONFIG_GETTERS.items()
+        if key in section
     }
 
 
-async def open_notepad(file):
-    proc = await asyncio.create_subprocess_exec(
-        "notepad.exe",
-        "config.ini",
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.DEVNULL,
-    )
-    await proc.wait()
-
-
-class point:
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
-
-    def in_bound(self, width, height):
-        return (0 <= self.x and self.x < width) and (0 <= self.y and self.y < height)
-
-    def move_in(self, width, height):
-        self.x %= width
-        self.y %= height
-
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
-
-    def __add__(self, other):
-        return point(self.x + other.x, self.y + other.y)
-
-    def __sub__(self, other):
-        return point(self.x - other.x, self.y - other.y)
-
-
-dir_to_ds = {
-    "L": point(-1, 0),
-    "R": point(1, 0),
-    "D": point(0, 1),
-    "U": point(0, -1),
-}
-
-
-def collinear_dir(dir1, dir2):
-    a = {"U", "D"}
-    b = {"L", "R"}
-    if dir1 in a and dir2 in a:
-        return True
-    if dir1 in b and dir2 in b:
-        return True
-    return False
-
-
-snake_num_to_chr = {
-    "apple": "A",
-    "snake 0": {"body": "c", "head": "C"},
-    "snake 1": {"body": "d", "head": "D"},
-}
+def check_settings(settings):
+    missing = CONFIG_GETTERS.keys() - settings.keys()
+    if missing:
+        raise ValueError(f"missing {", ".join(sorted(missing))}")
+    if not (settings["players_number"] in {1, 2}):
+        raise ValueError("number of players must be 1 or 2")
+    if not (settings["width"] >= 4):
+        raise ValueError("width must be at least 4")
+    if not (settings["height"] >= 4):
+        raise ValueError("height must be at least 4")
+    if not (settings["turn_time"] > 0):
+        raise ValueError("turn time must be positive")
+    if not (settings["tick_policy"] in POLICIES):
+        raise ValueError(f"tick policy must be one of {", ".join(POLICIES)}")
+    if not (settings["tick_timer"] in TIMERS):
+        raise ValueError(f"tick timer must be one of {", ".join(TIMERS)}")
+    return settings
+
+
+def load_config(path=CONFIG_PATH):
+    config = configparser.ConfigParser()
+    if not config.read(path, encoding="utf-8"):
+        raise FileNotFoundError(f"can't read {path}")
+    game = check_settings(CONFIG_DEFAULTS | read_section(config["game"]))
+    rooms = {}
+    matches = {}
+    for name in config.sections():
+        if name.startswith("room."):
+            settings = read_section(config[name])
+            check_settings(game | settings)
+            rooms[int(name.removeprefix("room."))] = settings
+        elif name.startswith("match."):
+            settings = read_section(config[name])
+            check_settings(game | settings)
+            matches[int(name.removeprefix("match."))] = settings
+    matches = [matches[num] for num in sorted(matches)]
+    return {"game": game, "rooms": rooms, "matches": matches}
+
+
+class config_watch:
+    def __init__(self, path=CONFIG_PATH, interval=CONFIG_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.mtime = self.get_mtime()
+        self.config = load_config(path)
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
 
+    def game_settings(self, room_num, match_num=0):
+        settings = self.config["game"] | self.config["rooms"].get(room_num, {})
+        matches = self.config["matches"]
+        if matches:
+            settings = settings | matches[match_num % len(matches)]
+        return settings
+
+    def formats(self):
+        rooms = [None, *self.config["rooms"]]
+        matches = range(max(1, len(self.config["matches"])))
+        boards = [self.game_settings(r, m) for r in rooms for m in matches]
+        if all(text_fits(b["width"], b["height"]) for b in boards):
+            return FORMATS
+        return [format for format in FORMATS if format != PROTO_TEXT]
 
-class snake:
-    def __init__(self, body: list[point], num: int):
-        self.body = body
-        self.num = num
-        self.prev_dir = ""
-        for key, val in dir_to_ds.items():
-            if val == body[-1] - body[-2]:
-                self.prev_dir = key
-        if self.prev_dir == "":
-            raise Exception("Incorrect init snake")
-        self.que = []
-
-    def add_grid_size(self, width: int, height: int):
-        self.width = width
-        self.height = height
-
-    def is_point_under(self, p: point, without_head_num=[]):
-        if self.num in without_head_num:
-            return p in self.body[:-1]
-        else:
-            return p in self.body
-
-    def make_turn(self, apples, has_bounds):
-        dir = self.prev_dir
-        if len(self.que) > 0:
-            dir = self.que[0]
-            self.que = self.que[1:]
-        self.prev_dir = dir
-        new_head = self.head() + dir_to_ds[dir]
-        if not has_bounds:
-            new_head.move_in(self.width, self.height)
-        self.body.append(new_head)
-        if self.head() not in apples:
-            self.body = self.body[1:]
-
-    def apply_direct(self, ndir):
-        pdir = self.prev_dir
-        if len(self.que) > 0:
-            pdir = self.que[-1]
-        if not collinear_dir(pdir, ndir) and len(self.que) < 3:
-            self.que.append(ndir)
-
-    def head(self):
-        return self.body[-1]
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self.get_mtime()
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                config = await asyncio.to_thread(load_config, self.path)
+            except Exception as e:
+                game_log.error(
+                    "error in %s: %s, keeping last good config", self.path, e
+                )
+                continue
+            self.config = config
+            game_log.info("%s reloaded: %s", self.path, config)
 
 
 class game:
-    def build_start_pos(self):
+    debug_delta = DEBUG_DELTA
+    recorder = None
+    metrics = None
+
+    def get_board(self):
+        key = (self.width, self.height, self.has_bound)
+        if getattr(self, "board_key", None) != key:
+            self.board = board(*key)
+            self.board_key = key
+        return self.board
+
+    def build_start_pos(self, seed=None):
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.stop_recording()
+        b = self.get_board()
         if self.players_number == 1:
             y = self.height // 2
             self.snakes = [
-                snake([point(0, y), point(1, y), point(2, y)], 0),
+                snake([point(0, y), point(1, y), point(2, y)], 0, b),
             ]
         elif self.players_number == 2:
             x = self.width - 1
             y = self.height - 2
             self.snakes = [
-                snake([point(0, 1), point(1, 1), point(2, 1)], 0),
-                snake([point(x, y), point(x - 1, y), point(x - 2, y)], 1),
+                snake([point(0, 1), point(1, 1), point(2, 1)], 0, b),
+                snake([point(x, y), point(x - 1, y), point(x - 2, y)], 1, b),
             ]
+        self.occupancy = occupancy(b)
+        self.changelog = []
         for s in self.snakes:
-            s.add_grid_size(self.width, self.height)
+            s.add_occupancy(self.occupancy)
+            s.add_changelog(self.changelog)
         self.end_game = False
-        self.apples = []
+        self.apples = set()
         self.gen_apples()
 
     def gen_apples(self):
         while len(self.apples) < self.apples_number:
-            p = self.get_free_cell()
-            if p:
-                self.apples.append(p)
+            c = self.get_free_cell()
+            if c is not None:
+                self.apples.add(c)
+                self.occupancy.add(c)
+                self.changelog.append(c)
             else:
                 break
         if len(self.apples) == 0:
             self.end_game = True
 
     def get_free_cell(self):
-        free = []
-        for x in range(self.width):
-            for y in range(self.height):
-                p = point(x, y)
-                is_free = p not in self.apples
-                for s in self.snakes:
-                    is_free = is_free and not s.is_point_under(p)
-                if is_free:
-                    free.append(p)
-        if len(free) == 0:
-            return None
-        else:
-            return random.choice(free)
+        return self.occupancy.random_free(self.rng)
 
     def construc_grid(self):
-        grid = [["."] * self.height for _ in range(self.width)]
+        grid = bytearray(b".") * self.board.size
         for apple in self.apples:
-            grid[apple.x][apple.y] = "A"
+            grid[apple] = ord(snake_num_to_chr["apple"])
         for s in self.snakes:
+            body = ord(snake_num_to_chr[f"snake {s.num}"]["body"])
             for segm in s.body:
-                if not segm.in_bound(self.width, self.height):
-                    continue
-                if segm == s.head():
-                    c = snake_num_to_chr[f"snake {s.num}"]["head"]
-                else:
-                    c = snake_num_to_chr[f"snake {s.num}"]["body"]
-                grid[segm.x][segm.y] = c
-
+                if segm != OUTSIDE:
+                    grid[segm] = body
+            head = s.body[-1]
+            if head != OUTSIDE:
+                grid[head] = ord(snake_num_to_chr[f"snake {s.num}"]["head"])
         return grid
 
+    def start_recording(self, path):
+        header = {key: getattr(self, key) for key in SETTINGS}
+        header["turn_time"] = self.turn_time
+        header["seed"] = self.seed
+        self.recorder = replay_writer(path, header)
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def apply_direct(self, num, dir):
+        if self.recorder:
+            self.recorder.input(num, dir)
+        self.snakes[num].apply_direct(dir)
+
     def make_turn(self):
+        if self.recorder:
+            self.recorder.turn()
         for s in self.snakes:
-            s.make_turn(self.apples, self.has_bound)
+            s.make_turn(self.apples)
         for s in self.snakes:
-            if s.head() in self.apples:
-                self.apples.remove(s.head())
-            if not s.head().in_bound(self.width, self.height):
+            head = s.body[-1]
+            if head in self.apples:
+                self.apples.remove(head)
+                self.occupancy.remove(head)
+            if head == OUTSIDE:
+                self.end_game = True
+            elif self.occupancy.count(head) > 1:
                 self.end_game = True
-            for t in self.snakes:
-                if t.is_point_under(s.head(), [s.num]):
-                    self.end_game = True
+        time_start = time.perf_counter()
         self.gen_apples()
+        if self.metrics:
+            self.metrics.observe("gen_apples", time.perf_counter() - time_start)
 
-    def get_string(self):
+    def cell_code(self, i: int):
+        code = "."
+        if i in self.apples:
+            code = snake_num_to_chr["apple"]
+        for s in self.snakes:
+            if i == s.body[-1]:
+                code = snake_num_to_chr[f"snake {s.num}"]["head"]
+            elif i in s.cells:
+                code = snake_num_to_chr[f"snake {s.num}"]["body"]
+        return ord(code)
+
+    def get_cells(self):
         grid = self.construc_grid()
         self.prev_grid = grid
-        grid_code = ""
-        for l in grid:
-            f = ""
-            for m in l:
-                f = f + m + ","
-            grid_code += f[:-1] + ":"
-        message = f"{self.width}|{self.height}|{grid_code[:-1]}"
-        return message
+        self.changelog.clear()
+        return grid
 
-    def get_delta(self):
+    def get_full_changes(self):
         grid = self.construc_grid()
-        res = b""
-        for x in range(self.width):
-            for y in range(self.height):
-                if grid[x][y] != self.prev_grid[x][y]:
-                    res += bytes([x + BYTE_CODE_SHIFT, y + BYTE_CODE_SHIFT])
-                    res += grid[x][y].encode()
-        self.prev_grid = grid
-        return res.decode()
+        return [(i, c) for i, (p, c) in enumerate(zip(self.prev_grid, grid)) if p != c]
+
+    def get_changes(self):
+        if self.debug_delta:
+            expected = self.get_full_changes()
+        changes = []
+        for i in sorted(set(self.changelog)):
+            if i == OUTSIDE:
+                continue
+            c = self.cell_code(i)
+            if self.prev_grid[i] != c:
+                self.prev_grid[i] = c
+                changes.append((i, c))
+        self.changelog.clear()
+        if self.debug_delta and changes != expected:
+            game_log.warning("delta log mismatch: %s != %s", changes, expected)
+            self.prev_grid = self.construc_grid()
+            changes = expected
+        return changes
 
-    async def update_settings(self):
-        while True:
-            try:
-                game_config = load_config()["game"]
-                self.players_number = game_config["players_number"]
-                if not (self.players_number in {1, 2}):
-                    raise ValueError("number of players must be 1 or 2")
-                self.width = game_config["width"]
-                if not (self.width >= 4):
-                    raise ValueError("width must be at least 4")
-                self.height = game_config["height"]
-                if not (self.height >= 4):
-                    raise ValueError("height must be at least 4")
-                self.turn_time = game_config["turn_time"]
-                self.apples_number = game_config["apples_number"]
-                self.has_bound = game_config["has_bound"]
-                self.build_start_pos()
-                return
-            except Exception as e:
-                print(f"error in config: {e}")
-                await open_notepad(CONFIG_PATH)
+    def get_string(self):
+        return encode_text_keyframe(self.width, self.height, self.get_cells())
+
+    def get_delta(self):
+        return encode_text_delta(self.height, self.get_changes())
+
+    def apply_settings(self, settings):
+        for key in CONFIG_GETTERS:
+            setattr(self, key, settings[key])
 
 
 async def read(client):
     try:
-        data = await client["reader"].readline()
-        message = data.decode().strip()
+        if client["proto"] == PROTO_BINARY:
+            kind, turn, payload = await read_frame(client["reader"])
+            if kind != MSG:
+                raise Exception(f"unexpected frame kind {kind}")
+            message = payload.decode().strip()
+        else:
+            data = await client["reader"].readline()
+            message = data.decode().strip()
         if message == "":
             raise Exception("client closed connection")
     except Exception as e:
@@ -294,22 +371,37 @@ async def read(client):
         )
         if "num" in client:
             args += (f"from client {client["num"]}",)
-        raise type(e)(*args)
+        raise Exception(*args) from e
     if "num" in client:
-        print(f"{message} is readed from {client["num"]}")
+        io_log.debug("%s is readed from %s", message, client["num"])
     else:
-        print(f"{message} is readed")
+        io_log.debug("%s is readed", message)
     return message
 
 
-async def write(client, message, timeout=1.0):
-    if not isinstance(message, str):
-        raise Exception(f"{message} isn't a string")
-    if not message:
-        raise Exception(f"message mustn't be clear")
-
+def encode_message(proto, message):
+    if isinstance(message, (bytes, memoryview)):
+        return message
+    if proto == PROTO_BINARY:
+        return encode_frame(MSG, 0, message.strip().encode())
+    return message.strip().encode() + b"\n"
+
+
+async def write(client, *messages, timeout=1.0):
+    data = []
+    for message in messages:
+        if isinstance(message, list):
+            data += message
+            continue
+        if not isinstance(message, (str, bytes, memoryview)):
+            raise Exception(f"{message} isn't a string")
+        if not message:
+            raise Exception(f"message mustn't be clear")
+        data.append(encode_message(client["proto"], message))
+
+    time_start = time.perf_counter()
     try:
-        client["writer"].write(message.strip().encode() + b"\n")
+        client["writer"].writelines(data)
         await asyncio.wait_for(client["writer"].drain(), timeout=timeout)
     except Exception as e:
         args = e.args + (
@@ -318,104 +410,545 @@ async def write(client, message, timeout=1.0):
         )
         if "num" in client:
             args += (f"to client {client["num"]}",)
-        raise type(e)(*args)
-    fmes = message
-    if message.startswith("STATE"):
-        fmes = message.split("|")[0]
-    if "num" in client:
-        print(f"{fmes} is writed to {client["num"]} (length = {len(message)})")
-    else:
-        print(f"{fmes} is writed (length = {len(message)})")
+        raise Exception(*args) from e
+    if "stats" in client:
+        size = sum(len(d) for d in data)
+        client["stats"].observe(time.perf_counter() - time_start, size)
+    if not io_log.isEnabledFor(logging.DEBUG):
+        return
+    for message in messages:
+        fmes = message
+        if not isinstance(message, str):
+            fmes = "FRAME"
+        elif message.startswith("STATE"):
+            fmes = message.split("|")[0]
+        if "num" in client:
+            num = client["num"]
+            io_log.debug("%s is writed to %s (length = %s)", fmes, num, len(message))
+        else:
+            io_log.debug("%s is writed (length = %s)", fmes, len(message))
+
+
+class sender:
+    def __init__(self, client, size=SEND_QUEUE_SIZE, policy=SLOW_CLIENT_POLICY):
+        self.client = client
+        self.size = size
+        self.policy = policy
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.error = None
+        self.closing = False
+        self.task = asyncio.create_task(self.run())
+
+    def depth(self):
+        return len(self.queue)
+
+    def put(self, message, keyframe=None):
+        if self.error:
+            return
+        if len(self.queue) >= self.size:
+            if self.policy == "disconnect":
+                num = self.client.get("num")
+                args = ("send queue overflow", "connection lost", f"to client {num}")
+                self.fail(Exception(*args))
+                return
+            if self.policy == "drop":
+                self.client["stats"].dropped += 1
+                return
+            if keyframe is not None:
+                kept = deque(m for m in self.queue if not m[1])
+                self.client["stats"].dropped += len(self.queue) - len(kept)
+                self.queue = kept
+                message = keyframe(self.client["format"])
+        self.queue.append((message, keyframe is not None))
+        self.client["stats"].queued(len(self.queue))
+        self.ready.set()
 
+    async def run(self):
+        try:
+            await self.flush()
+        finally:
+            if self.closing:
+                self.client["writer"].close()
 
-async def check_ping(client):
-    time_start = asyncio.get_event_loop().time()
-    await write(client, "PING")
-    mes = await read(client)
-    if mes == "PONG":
-        return asyncio.get_event_loop().time() - time_start
+    async def flush(self):
+        while True:
+            while len(self.queue) == 0:
+                if self.closing:
+                    return
+                self.ready.clear()
+                await self.ready.wait()
+            messages = [message for message, _ in self.queue]
+            self.queue.clear()
+            self.client["stats"].queued(0)
+            try:
+                await write(self.client, *messages)
+            except Exception as e:
+                self.fail(e)
+                return
 
+    def fail(self, e):
+        self.error = e
+        self.queue.clear()
+        self.client["writer"].close()
+
+    def close(self):
+        self.task.cancel()
+
+    def finish(self, message=None):
+        if message is not None:
+            self.put(message)
+        self.closing = True
+        self.ready.set()
+        if self.task.done():
+            self.client["writer"].close()
+
+
+def send(client, message, keyframe=None):
+    if client["sender"].error:
+        raise client["sender"].error
+    client["sender"].put(message, keyframe)
+
+
+class receiver:
+    def __init__(self, client):
+        self.client = client
+        self.queues = {kind: asyncio.Queue() for kind in REPLIES}
+        self.on_dir = None
+        self.on_error = None
+        self.error = None
+        self.pending = set()
+        self.task = asyncio.create_task(self.run())
+
+    def handle(self, on_dir=None, on_error=None):
+        self.on_dir = on_dir
+        self.on_error = on_error
+        self.pending.clear()
+        if self.error and on_error:
+            on_error(self.error)
+
+    def expect(self, kind):
+        queue = self.queues[kind]
+        while not queue.empty() and not self.error:
+            queue.get_nowait()
+        self.pending.add(kind)
+
+    async def get(self, kind, timeout=None):
+        if self.error:
+            raise self.error
+        message = await asyncio.wait_for(self.queues[kind].get(), timeout)
+        self.pending.discard(kind)
+        if isinstance(message, Exception):
+            raise message
+        return message
 
-class server:
-    async def handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        if self.state == "wait_clients" and not self.wait_clients_event.is_set():
-            client = {
-                "reader": reader,
-                "writer": writer,
-            }
-            self.clients.append(client)
-            await write(client, "ok")
-            if len(self.clients) == self.game.players_number:
-                self.wait_clients_event.set()
+    async def run(self):
+        while True:
+            try:
+                message = await read(self.client)
+            except Exception as e:
+                self.fail(e)
+                return
+            if message in dir_to_ds:
+                if self.on_dir:
+                    self.on_dir(message)
+            elif message == "PONG":
+                now = asyncio.get_event_loop().time()
+                self.client["stats"].latency.pong(now)
+            elif message in self.queues:
+                self.queues[message].put_nowait(message)
+            else:
+                io_log.warning("unexpected %r from %s", message, self.client.get("num"))
+
+    def fail(self, e):
+        self.error = e
+        for queue in self.queues.values():
+            queue.put_nowait(e)
+        if self.on_error:
+            self.on_error(e)
+
+    def close(self):
+        self.task.cancel()
+
+
+class heartbeat:
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.clients = {}
+
+    def add(self, client):
+        self.clients[id(client)] = client
+
+    def beat(self, now):
+        for key, client in list(self.clients.items()):
+            r = client["receiver"]
+            if r.error or r.task.done() or client["sender"].error:
+                del self.clients[key]
+                continue
+            latency = client["stats"].latency
+            if r.pending:
+                latency.hold(now)
+                continue
+            if latency.overdue(now, self.timeout):
+                del self.clients[key]
+                num = client.get("num")
+                r.fail(Exception("heartbeat timeout", "connection lost", f"{num}"))
+                r.close()
+                continue
+            latency.ping(now)
+            send(client, "PING")
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.beat(loop.time())
+
+
+class stagger:
+    def __init__(self, slots=TICK_SLOTS):
+        self.slots = [0] * slots
+
+    def acquire(self):
+        slot = self.slots.index(min(self.slots))
+        self.slots[slot] += 1
+        return slot
+
+    def release(self, slot):
+        self.slots[slot] -= 1
+
+    def start_time(self, slot, turn_time, now):
+        offset = turn_time * slot / len(self.slots)
+        start = now - now % turn_time + offset
+        if start < now:
+            start += turn_time
+        return start
+
+
+class stream:
+    def __init__(self, room):
+        self.room = room
+        self.spectators = []
+        self.frames = None
+        self.bridge = {}
+        self.joined = {}
+        self.first_turn = 0
+        self.turn = -1
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def add(self, client):
+        client["turn"] = -1
+        self.spectators.append(client)
+        self.track(client["format"])
+        self.ready.set()
+
+    def track(self, format):
+        if self.room.state != "game_cycle":
+            return
+        if self.frames is None or format not in self.frames:
+            formats = set(self.frames or ()) | {format}
+            keyframes = self.encode("STATE_INIT", self.room.game.prev_grid, formats)
+            self.reset(self.room.turn, keyframes)
+
+    def remove(self, client):
+        self.spectators.remove(client)
+        client["sender"].close()
+        client["writer"].close()
+
+    def encode(self, prefix, data, formats, messages=None):
+        messages = messages or {}
+        encoded = {format: messages[format] for format in formats if format in messages}
+        missing = [format for format in formats if format not in messages]
+        if missing:
+            encoded |= self.room.encode_state(prefix, data, missing)
+        return encoded
+
+    def reset(self, turn, keyframes, bridge=None):
+        self.frames = {format: [frame] for format, frame in keyframes.items()}
+        self.bridge = bridge or {}
+        self.first_turn = turn
+        self.turn = turn
+
+    def publish(self, prefix, data, messages):
+        turn = self.room.turn
+        formats = messages.keys()
+        self.joined = {}
+        if self.frames is None or prefix == "STATE_INIT":
+            for client in self.spectators:
+                client["turn"] = -1
+            if prefix != "STATE_INIT":
+                data, messages = self.room.game.prev_grid, {}
+            self.reset(turn, self.encode("STATE_INIT", data, formats, messages))
+        elif turn - self.first_turn >= KEYFRAME_TURNS or formats != self.frames.keys():
+            grid = self.room.game.prev_grid
+            self.reset(turn, self.encode("STATE_INIT", grid, formats), messages)
         else:
-            writer.write(b"Game already started\n")
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
+            for format, frame in messages.items():
+                self.frames[format].append(frame)
+            self.turn = turn
+        self.ready.set()
+
+    def keyframe(self, format):
+        if format not in self.joined:
+            self.joined[format] = b"".join(self.frames[format])
+        return self.joined[format]
+
+    def catch_up(self, client):
+        format = client["format"]
+        if format not in (self.frames or {}) or client["turn"] >= self.turn:
+            return
+        frames = self.frames[format]
+        if client["turn"] >= self.first_turn:
+            data = frames[client["turn"] - self.first_turn + 1 :]
+        elif client["turn"] == self.first_turn - 1 and format in self.bridge:
+            data = [self.bridge[format]] + frames[1:]
+        else:
+            data = self.keyframe(format)
+        send(client, data, self.keyframe)
+        client["turn"] = self.turn
 
-    async def check_clients(self):
-        alive_clients = []
-        for client in self.clients:
+    def write_all(self, message):
+        for client in list(self.spectators):
             try:
-                await write(client, "TEST")
-                answer = await asyncio.wait_for(read(client), timeout=1.0)
-                if answer == "TEST_ANSWER":
-                    alive_clients.append(client)
-            except:
-                pass
-        self.clients = alive_clients
+                self.catch_up(client)
+                send(client, message)
+                client["turn"] = -1
+            except Exception:
+                self.remove(client)
+        self.frames = None
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            for i, client in enumerate(list(self.spectators)):
+                try:
+                    self.catch_up(client)
+                except Exception:
+                    self.remove(client)
+                if i % FANOUT_BATCH == FANOUT_BATCH - 1:
+                    await asyncio.sleep(0)
+
+    def close(self):
+        self.task.cancel()
+        for client in self.spectators:
+            client["sender"].finish()
+        self.spectators = []
+
+
+class room:
+    def __init__(self, num, stagger, config):
+        self.num = num
+        self.stagger = stagger
+        self.config = config
+        self.matches = 0
+        self.clients = []
+        self.stream = stream(self)
+        self.state = "wait_clients"
+        self.turn = 0
+        self.game = game()
+        self.metrics = tick_metrics()
+        self.game.metrics = self.metrics
+        self.writer = frame_writer()
+        self.wait_clients_event = asyncio.Event()
+
+    def accepts_clients(self):
+        if self.state != "wait_clients" or self.wait_clients_event.is_set():
+            return False
+        return len(self.clients) < self.game.players_number
+
+    def add_client(self, client):
+        self.clients.append(client)
+        if len(self.clients) == self.game.players_number:
+            self.wait_clients_event.set()
 
-    async def write_all(self, message, timeout=1.0):
+    def close(self):
         for client in self.clients:
-            await write(client, message, timeout=timeout)
+            client["sender"].close()
+            client["receiver"].close()
+            client["writer"].close()
+        self.clients = []
+        self.stream.close()
 
-    async def read_all(self):
-        answer = [""] * len(self.clients)
+    def check_clients(self):
+        alive_clients = []
         for client in self.clients:
-            answer[client["num"]] = await read(client)
-        return answer
+            if "lost" in client or client["receiver"].error or client["sender"].error:
+                client["sender"].close()
+                client["receiver"].close()
+                client["writer"].close()
+            else:
+                alive_clients.append(client)
+        self.clients = alive_clients
 
-    async def send_state(self, prefix):
+    def drop_text_clients(self):
+        if text_fits(self.game.width, self.game.height):
+            return
+        refused = [c for c in self.clients if c["proto"] == PROTO_TEXT]
+        for client in refused:
+            client["sender"].finish(TEXT_REFUSED)
+            client["receiver"].close()
+        self.clients = [c for c in self.clients if c not in refused]
+        for client in list(self.stream.spectators):
+            if client["proto"] == PROTO_TEXT:
+                self.stream.spectators.remove(client)
+                client["sender"].finish(TEXT_REFUSED)
+
+    def rtt(self):
+        return max((c["stats"].latency.rtt or 0.0 for c in self.clients), default=0.0)
+
+    def write_all(self, message, keyframe=None):
+        error = None
+        for client in self.clients:
+            if "lost" in client:
+                continue
+            try:
+                if isinstance(message, dict):
+                    send(client, message[client["format"]], keyframe)
+                else:
+                    send(client, message, keyframe)
+            except Exception as e:
+                if self.state == "game_cycle":
+                    self.lose(client)
+                else:
+                    error = error or e
+        if error:
+            raise error
+
+    def lose(self, client):
+        if "lost" in client:
+            return
+        client["lost"] = asyncio.get_event_loop().time()
+        client["sender"].close()
+        client["receiver"].close()
+        client["writer"].close()
+        num = client["num"]
+        room_log.warning("room %s: client %s lost, waiting for resume", self.num, num)
+
+    def check_lost(self, now):
+        for client in self.clients:
+            if "lost" in client and now - client["lost"] > RESUME_TIMEOUT:
+                raise Exception(
+                    "resume timeout",
+                    "connection lost",
+                    f"to client {client["num"]}",
+                )
+
+    def resume(self, client, token, turn):
+        if self.state != "game_cycle":
+            return False
+        for i, old in enumerate(self.clients):
+            if old.get("session") == token and "lost" in old:
+                client["num"] = old["num"]
+                client["session"] = token
+                client["turn"] = turn if turn <= self.turn else -1
+                self.clients[i] = client
+                send(client, f"SESSION|{token}")
+                send(client, f"YOU|{client["num"]}|{int(self.game.has_bound)}")
+                self.stream.track(client["format"])
+                self.stream.catch_up(client)
+                self.start_reader(client)
+                num = client["num"]
+                room_log.info("room %s: client %s resumed at %s", self.num, num, turn)
+                return True
+        return False
+
+    def queue_depths(self):
+        return {c.get("num"): c["sender"].depth() for c in self.clients}
+
+    async def read_all(self, kind):
+        receivers = [client["receiver"] for client in self.clients]
+        return await asyncio.gather(*[r.get(kind) for r in receivers])
+
+    def encode_state(self, prefix, data, formats):
+        width, height = self.game.width, self.game.height
+        out = self.writer
+        bounds = {}
+        shared = {}
+        for format in formats:
+            proto, encoding = split_format(format)
+            if prefix != "STATE_INIT" and proto in shared:
+                bounds[format] = shared[proto]
+                continue
+            start = out.pos
+            if proto == PROTO_BINARY:
+                header = out.begin_frame()
+                if prefix == "STATE_INIT":
+                    out.keyframe(width, height, data, encoding)
+                    out.end_frame(header, STATE_INIT, self.turn)
+                else:
+                    out.delta(data)
+                    out.end_frame(header, STATE, self.turn)
+            else:
+                out.write(f"{prefix}|".encode())
+                if prefix == "STATE_INIT":
+                    out.text_keyframe(width, height, data)
+                else:
+                    out.text_delta(height, data)
+                out.write(b"\n")
+            bounds[format] = shared[proto] = (start, out.pos)
+        view = out.snapshot()
+        return {format: view[start:end] for format, (start, end) in bounds.items()}
+
+    def formats(self):
+        clients = self.clients + self.stream.spectators
+        return {client["format"] for client in clients}
+
+    def send_state(self, prefix):
+        time_start = time.perf_counter()
         if prefix == "STATE_INIT":
-            message = f"{prefix}|{self.game.get_string()}"
+            data = self.game.get_cells()
         else:
-            message = f"{prefix}|{self.game.get_delta()}"
-        await self.write_all(message)
-
-    async def dir_reader(self, client):
-        while not self.dirr_shutdown.is_set():
-            read_task = asyncio.create_task(read(client))
-            shutdown_task = asyncio.create_task(self.dirr_shutdown.wait())
-            done, pending = await asyncio.wait(
-                [read_task, shutdown_task], return_when=asyncio.FIRST_COMPLETED
-            )
-            for task in pending:
-                task.cancel()
-            if shutdown_task in done:
-                break
-            if read_task in done:
-                input = await read_task
-                if input not in dir_to_ds:
-                    raise Exception(
-                        "incorrect direction",
-                        "connection lost",
-                        f"while reading from {client["num"]}",
-                    )
-                self.game.snakes[client["num"]].apply_direct(input)
-
-    async def stop_readers(self):
-        await asyncio.sleep(0.1)
-        self.dirr_shutdown.set()
-        await asyncio.sleep(0.1)
+            data = self.game.get_changes()
+        time_delta = time.perf_counter()
+        messages = self.encode_state(prefix, data, self.formats())
+        time_encode = time.perf_counter()
+
+        def keyframe(format):
+            grid = self.game.construc_grid()
+            return self.encode_state("STATE_INIT", grid, [format])[format]
+
+        self.write_all(messages, keyframe)
+        time_write = time.perf_counter()
+        self.stream.publish(prefix, data, messages)
+        time_publish = time.perf_counter()
+        self.metrics.observe("get_delta", time_delta - time_start)
+        self.metrics.observe("encode", time_encode - time_delta)
+        self.metrics.observe("write_all", time_write - time_encode)
+        self.metrics.observe("publish", time_publish - time_write)
+
+    def start_reader(self, client):
+        def on_dir(dir):
+            self.game.apply_direct(client["num"], dir)
+
+        client["receiver"].handle(on_dir, lambda e: self.lose(client))
+
+    def stop_readers(self):
+        for client in self.clients:
+            client["receiver"].handle()
+
+    def next_settings(self):
+        return self.config.game_settings(self.num, self.matches)
 
     async def wait_clients(self):
+        self.game.apply_settings(self.next_settings())
+        self.drop_text_clients()
         try:
-            await self.write_all("END_GAME")
+            self.write_all("END_GAME")
         except:
             pass
-        await self.stop_readers()
-        await self.check_clients()
+        self.stream.write_all("END_GAME")
+        self.stop_readers()
+        self.check_clients()
+        if len(self.clients) == 0:
+            self.state = "closed"
+            return
         if len(self.clients) > self.game.players_number:
+            for client in self.clients[self.game.players_number :]:
+                client["sender"].finish(ROOM_FULL)
+                client["receiver"].close()
             self.clients = self.clients[: self.game.players_number]
         self.wait_clients_event.clear()
         if len(self.clients) == self.game.players_number:
@@ -426,82 +959,422 @@ class server:
         self.state = "wait_restart"
 
     async def wait_restart(self):
-        await self.stop_readers()
-        await self.write_all("SPACE_AWAIT")
-        ans = await self.read_all()
+        self.stop_readers()
         for client in self.clients:
-            print(f"PING from {client["num"]} = {(await check_ping(client)):.4f}")
-            if ans[client["num"]] != "SPACE_PRESSED":
-                self.state = "wait_clients"
+            client["receiver"].expect("SPACE_PRESSED")
+        self.write_all("SPACE_AWAIT")
+        await self.read_all("SPACE_PRESSED")
+        room_log.debug("room %s: max rtt %.4f", self.num, self.rtt())
         self.state = "game_start"
 
     async def game_start(self):
-        await self.game.update_settings()
+        settings = self.next_settings()
+        text = any(client["proto"] == PROTO_TEXT for client in self.clients)
+        if settings["players_number"] != len(self.clients) or (
+            text and not text_fits(settings["width"], settings["height"])
+        ):
+            self.state = "wait_clients"
+            return
+        self.game.apply_settings(settings)
+        self.matches += 1
+        self.metrics.start_match()
         self.game.build_start_pos()
-        await self.send_state("STATE_INIT")
+        if RECORD_REPLAYS:
+            os.makedirs(REPLAY_DIR, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            name = f"{SERVER_ID}-room{self.num}-{stamp}-{self.game.seed}.replay"
+            self.game.start_recording(os.path.join(REPLAY_DIR, name))
+        self.turn = 0
+        for client in self.clients:
+            send(client, f"YOU|{client["num"]}|{int(self.game.has_bound)}")
+        self.send_state("STATE_INIT")
         self.state = "game_cycle"
-        self.dirr_shutdown.clear()
         for client in self.clients:
-            asyncio.create_task(self.dir_reader(client))
+            self.start_reader(client)
 
     async def game_cycle(self):
         loop = asyncio.get_event_loop()
-        self.turn = 0
-        time_cycle = loop.time()
-        while self.state == "game_cycle":
+        slot = self.stagger.acquire()
+        try:
+            await self.tick_loop(loop, slot)
+        finally:
+            self.stagger.release(slot)
+            self.game.stop_recording()
+
+    async def tick_loop(self, loop, slot):
+        start = self.stagger.start_time(slot, self.game.turn_time, loop.time())
+        ticks = scheduler(
+            loop,
+            self.game.turn_time,
+            start,
+            self.game.tick_policy,
+            self.game.tick_timer,
+        )
+        while True:
+            late = await ticks.wait()
+            if late is not None:
+                self.metrics.observe_jitter(late)
+            if self.state != "game_cycle":
+                return
+            self.check_lost(loop.time())
+            time_start = time.perf_counter()
             self.game.make_turn()
-            await self.send_state("STATE")
+            self.metrics.observe("make_turn", time.perf_counter() - time_start)
+            self.turn += 1
+            self.send_state("STATE")
+            self.metrics.observe("tick", time.perf_counter() - time_start)
             if self.game.end_game == True:
-                await self.write_all("END_GAME")
+                self.write_all("END_GAME")
+                self.stream.write_all("END_GAME")
+                self.print_summary()
+                if any("lost" in client for client in self.clients):
+                    raise Exception("game ended without resume", "connection lost")
                 self.state = "wait_restart"
                 return
 
-            time_cycle += self.game.turn_time
-            sleep_time = time_cycle - loop.time()
-            if sleep_time < 0:
-                print(f"Turn {self.turn} lag: {-sleep_time:.3f}s")
-                time_cycle = loop.time()
-            else:
-                await asyncio.sleep(sleep_time)
-            self.turn += 1
+            now = loop.time()
+            skipped = ticks.advance(now, self.rtt())
+            self.metrics.skip(skipped)
+            if ticks.lag > 0:
+                tick_log.warning(
+                    "room %s: Turn %s lag: %.3fs, %s skipped, %s, last tick ms: %s",
+                    self.num,
+                    self.turn,
+                    ticks.lag,
+                    skipped,
+                    self.queue_depths(),
+                    self.metrics.last(),
+                )
+
+    def print_summary(self):
+        summary = (self.metrics.match or self.metrics).summary()
+        tick_log.info("room %s: turn %s %s", self.num, self.turn, summary)
+        for client in self.clients:
+            summary = client["stats"].summary()
+            tick_log.info("room %s: client %s %s", self.num, client["num"], summary)
+        spectators = self.stream.spectators
+        if spectators:
+            sent = sum(c["stats"].bytes for c in spectators)
+            dropped = sum(c["stats"].dropped for c in spectators)
+            count = len(spectators)
+            tick_log.info(
+                "room %s: %s spectators, %s bytes, %s dropped",
+                self.num,
+                count,
+                sent,
+                dropped,
+            )
 
     async def run(self):
-        while True:
-            print(self.state)
+        while self.state != "closed":
+            room_log.info("room %s: %s", self.num, self.state)
             try:
                 method = getattr(self, self.state)
                 await method()
             except Exception as e:
-                print(f"error: {repr(e)}")
+                room_log.warning("room %s: error: %r", self.num, e)
                 if "connection lost" in e.args:
                     self.state = "wait_clients"
                     await asyncio.sleep(1)
                 else:
                     raise
 
-    async def start(self):
-        self.clients = {}
-        self.state = "wait_clients"
-        self.turn_time = 0.3
-        self.game = game()
-        self.dir_task = []
-        self.dirr_shutdown = asyncio.Event()
-        await self.game.update_settings()
-        self.game.build_start_pos()
-        self.wait_clients_event = asyncio.Event()
-        asyncio.create_task(udp_responder())
+
+class server:
+    async def handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not self.has_place():
+            writer.write(b"Server is full\n")
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+            return
+        client = {
+            "reader": reader,
+            "writer": writer,
+            "proto": PROTO_TEXT,
+            "format": PROTO_TEXT,
+        }
+        client["stats"] = client_stats()
+        client["sender"] = sender(client)
+        client["session"] = uuid.uuid4().hex
+        try:
+            send(client, "ok")
+            send(client, f"SESSION|{client["session"]}")
+            await self.negotiate(client)
+        except Exception as e:
+            io_log.info("handshake failed: %r", e)
+            client["sender"].close()
+            writer.close()
+            return
+        if client["proto"] == PROTO_TEXT and PROTO_TEXT not in self.config.formats():
+            client["sender"].finish(TEXT_REFUSED)
+            return
+        if client.get("role") == "spectator":
+            r = self.find_show(client.pop("room", None))
+            if r is None:
+                client["sender"].finish("No games to watch")
+                return
+            r.stream.add(client)
+            return
+        client["receiver"] = receiver(client)
+        self.heartbeat.add(client)
+        if "resume" in client:
+            token, turn = client.pop("resume")
+            if any(r.resume(client, token, turn) for r in self.rooms):
+                return
+        async with self.rooms_lock:
+            r = await self.find_room()
+            if r is None:
+                client["sender"].close()
+                client["receiver"].close()
+                writer.close()
+                return
+            r.add_client(client)
+
+    def has_place(self):
+        if len(self.rooms) < MAX_ROOMS:
+            return True
+        return any(r.accepts_clients() for r in self.rooms)
+
+    async def find_room(self):
+        for r in self.rooms:
+            if r.accepts_clients():
+                return r
+        if len(self.rooms) >= MAX_ROOMS:
+            return None
+        nums = {r.num for r in self.rooms}
+        num = next(num for num in range(len(self.rooms) + 1) if num not in nums)
+        r = room(num, self.stagger, self.config)
+        r.game.apply_settings(r.next_settings())
+        r.game.build_start_pos()
+        self.rooms.append(r)
+        asyncio.create_task(self.run_room(r))
+        return r
+
+    def find_show(self, num=None):
+        if num is not None:
+            return next((r for r in self.rooms if r.num == num), None)
+        playing = [r for r in self.rooms if r.state == "game_cycle"]
+        if playing:
+            return playing[0]
+        if self.rooms:
+            return self.rooms[0]
+        return None
+
+    async def run_room(self, r):
+        try:
+            await r.run()
+        except Exception as e:
+            server_log.error("room %s crashed: %r", r.num, e)
+        finally:
+            r.close()
+            self.rooms.remove(r)
+            server_log.info("room %s closed, %s rooms left", r.num, len(self.rooms))
+
+    async def negotiate(self, client):
+        send(client, f"PROTO|{','.join(self.config.formats())}")
+        try:
+            answer = await asyncio.wait_for(read(client), timeout=PROTO_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+        if not answer.startswith("PROTO|"):
+            return
+        format, *role = answer.removeprefix("PROTO|").split("|")
+        if format in FORMATS:
+            client["format"] = format
+            client["proto"] = split_format(format)[0]
+        if role[:1] == ["spectator"] and len(role) <= 2:
+            client["role"] = "spectator"
+            if len(role) == 2 and role[1].isdigit():
+                client["room"] = int(role[1])
+        elif len(role) == 3 and role[0] == "RESUME":
+            try:
+                client["resume"] = (role[1], int(role[2]))
+            except ValueError:
+                pass
+
+    def load(self):
+        return sum(len(r.clients) + len(r.stream.spectators) for r in self.rooms)
+
+    def collect_metrics(self):
+        rooms = [(f'room="{r.num}"', r.metrics) for r in self.rooms]
+        clients = []
+        for r in self.rooms:
+            for c in r.clients:
+                labels = f'room="{r.num}",client="{c["num"]}",role="player"'
+                clients.append((labels, c["stats"]))
+            for i, c in enumerate(r.stream.spectators):
+                labels = f'room="{r.num}",client="{i}",role="spectator"'
+                clients.append((labels, c["stats"]))
+        return render(rooms, clients)
+
+    def start_metrics(self, port):
+        if port:
+            asyncio.create_task(serve(port, self.collect_metrics))
+
+    def init_rooms(self):
+        self.rooms = []
+        self.rooms_lock = asyncio.Lock()
+        self.stagger = stagger()
+        self.config = config_watch()
+        self.heartbeat = heartbeat()
+
+    async def start(self, metrics_port=None):
+        self.init_rooms()
+        self.start_metrics(metrics_port)
+        asyncio.create_task(self.config.run())
+        asyncio.create_task(self.heartbeat.run())
+        asyncio.create_task(udp_responder(self.load))
         self.server = await asyncio.start_server(
             self.handler, host="0.0.0.0", port=TCP_PORT
         )
         await self.server.start_serving()
         for sock in self.server.sockets:
-            print(f"tcp server started at {sock.getsockname()}")
-        await self.run()
+            server_log.info("tcp server started at %s", sock.getsockname())
+        await self.server.serve_forever()
+
+    async def start_worker(self, sockets, loads, metrics_port=None):
+        self.init_rooms()
+        self.start_metrics(metrics_port)
+        asyncio.create_task(self.config.run())
+        asyncio.create_task(self.heartbeat.run())
+        loop = asyncio.get_event_loop()
+        args = (loop, sockets, asyncio.current_task())
+        threading.Thread(target=self.receive_sockets, args=args, daemon=True).start()
+        while True:
+            try:
+                loads.send(self.load())
+            except OSError:
+                return
+            await asyncio.sleep(LOAD_REPORT_INTERVAL)
 
+    def receive_sockets(self, loop, sockets, main_task):
+        while True:
+            try:
+                sock = sockets.recv()
+            except EOFError:
+                server_log.info("router is gone, stopping worker")
+                loop.call_soon_threadsafe(main_task.cancel)
+                return
+            asyncio.run_coroutine_threadsafe(self.accept_socket(sock), loop)
+
+    async def accept_socket(self, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handler(reader, writer)
+
+
+def run_worker(sockets, loads, metrics_port=None, log_settings=None):
+    log.setup(**(log_settings or {}))
+    try:
+        asyncio.run(server().start_worker(sockets, loads, metrics_port))
+    except asyncio.CancelledError:
+        pass
+
+
+class router:
+    def __init__(self, workers: int, metrics_port=None):
+        self.workers = workers
+        self.metrics_port = metrics_port
+
+    def load(self):
+        return sum(self.loads[num] for num in self.alive)
+
+    def receive_loads(self, num, loads):
+        while True:
+            try:
+                self.loads[num] = loads.recv()
+            except EOFError:
+                return
 
-async def main():
-    s = server()
-    await s.start()
+    def check_workers(self):
+        for num in list(self.alive):
+            if not self.processes[num].is_alive():
+                self.alive.remove(num)
+                code = self.processes[num].exitcode
+                server_log.error("worker %s exited with code %s", num, code)
 
+    def route(self, sock):
+        while True:
+            self.check_workers()
+            if not self.alive:
+                return None
+            num = min(self.alive, key=lambda n: self.loads[n])
+            try:
+                self.pipes[num].send(sock)
+            except OSError:
+                self.alive.discard(num)
+                server_log.error("worker %s is unreachable", num)
+                continue
+            self.loads[num] += 1
+            return num
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=1.0)
+
+    async def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.loads = [0] * self.workers
+        self.pipes = []
+        self.processes = []
+        for num in range(self.workers):
+            sockets_recv, sockets_send = context.Pipe(duplex=False)
+            loads_recv, loads_send = context.Pipe(duplex=False)
+            metrics_port = self.metrics_port and self.metrics_port + num
+            args = (sockets_recv, loads_send, metrics_port, log.settings)
+            process = context.Process(target=run_worker, args=args, daemon=True)
+            process.start()
+            sockets_recv.close()
+            loads_send.close()
+            args = (num, loads_recv)
+            threading.Thread(target=self.receive_loads, args=args, daemon=True).start()
+            self.pipes.append(sockets_send)
+            self.processes.append(process)
+        self.alive = set(range(self.workers))
+        try:
+            await self.serve()
+        finally:
+            self.stop()
+
+    async def serve(self):
+        asyncio.create_task(udp_responder(self.load))
+        loop = asyncio.get_event_loop()
+        listener = socket.create_server(("0.0.0.0", TCP_PORT))
+        listener.setblocking(False)
+        address = listener.getsockname()
+        server_log.info("router started at %s, %s workers", address, self.workers)
+        while True:
+            sock, addr = await loop.sock_accept(listener)
+            num = self.route(sock)
+            sock.close()
+            if num is None:
+                server_log.error("no workers left, %s is dropped", addr)
+            else:
+                server_log.debug("%s is routed to worker %s", addr, num)
 
-asyncio.run(main())
+
+async def main(workers=0, metrics_port=METRICS_PORT):
+    if workers > 0:
+        await router(workers, metrics_port).start()
+    else:
+        await server().start(metrics_port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT)
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--debug", default="", help="categories, e.g. io,udp")
+    parser.add_argument("--log-sample", default="", help="e.g. io=0.01")
+    parser.add_argument("--log-rate", default="", help="per second, e.g. io=100")
+    args = parser.parse_args()
+    log.setup(
+        args.log_level,
+        args.debug.split(","),
+        log.parse_pairs(args.log_sample),
+        log.parse_pairs(args.log_rate, int),
+    )
+    asyncio.run(main(args.workers, args.metrics_port))
@@ -1,22 +1,7 @@
 import pygame
 import asyncio
 import random
-
-
-class point:
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
-
-    def in_bound(self, width, height):
-        return (0 <= self.x and self.x < width) and (0 <= self.y and self.y < height)
-
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
-
-    def __add__(self, other):
-        return point(self.x + other.x, self.y + other.y)
-
+from geometry import point
 
 cell = 50
 width = 15